@@ -0,0 +1,61 @@
+# bench_compression.py - Bytes economizados x tempo de CPU da compressão de payloads MQTT
+#
+# Rodar no Pico W (MicroPython >= 1.21) com a biblioteca umqtt de qualquer projeto:
+#   mpremote cp -r rele_control/umqtt : + run benchmarks/bench_compression.py
+
+import json
+from umqtt.simple import MQTTClient
+
+RODADAS = 20
+
+# Payloads reais dos firmwares: discovery do Home Assistant e telemetria agrupada
+PAYLOADS = {
+    "discovery_led": json.dumps({
+        "name": "LED 1 Pico W",
+        "unique_id": "picow_led1",
+        "schema": "state",
+        "state_topic": "picow/led1/state",
+        "command_topic": "picow/led1/set",
+        "icon": "mdi:led-on",
+        "optimistic": False,
+        "retain": True,
+        "brightness": False,
+        "availability_topic": "picow/status",
+        "payload_available": "online",
+        "payload_not_available": "offline"
+    }),
+    "discovery_umidade": json.dumps({
+        "name": "Umidade do Solo",
+        "device_class": "moisture",
+        "state_topic": "homeassistant/binary_sensor/umidade_solo/state",
+        "payload_on": "0",
+        "payload_off": "1",
+        "unique_id": "umidade_solo_digital",
+        "device": {
+            "identifiers": ["umidade_solo_digital"],
+            "name": "Sensor de Umidade Digital",
+            "model": "FC-28",
+            "manufacturer": "BitDogLab"
+        }
+    }),
+    "telemetria_60": json.dumps([{"t": 1700000000 + 60 * i, "temp": 24.5 + (i % 7) / 10} for i in range(60)]),
+    "estado_on": "ON",
+}
+
+cliente = MQTTClient("bench", "localhost")
+cliente.set_compression(threshold=0)
+
+print("payload               bytes   comprimido  economia   us/compr  us/descompr")
+for nome, payload in PAYLOADS.items():
+    payload = payload.encode()
+    for k in cliente.stats:
+        cliente.stats[k] = 0
+    for _ in range(RODADAS):
+        z = cliente._compress(payload)
+    if z is not payload:
+        for _ in range(RODADAS):
+            cliente._decompress(z)
+    economia = 100 * (len(payload) - len(z)) // len(payload)
+    print("%-20s %6d %12d %8d%% %10d %12d" % (
+        nome, len(payload), len(z), economia,
+        cliente.stats["z_us"] // RODADAS, cliente.stats["unz_us"] // RODADAS))
@@ -0,0 +1,59 @@
+# bench_pid.py - Alocação de packet ids com muitas mensagens QoS 1 em voo
+#
+# Compara o pid_gen antigo (incrementa e dá a volta em 65535 sem olhar o que está em voo)
+# com o PidAllocator do MQTTClient. Alguns ids nunca recebem PUBACK durante o teste, como
+# mensagens presas numa reconexão, e os demais são confirmados fora de ordem.
+#
+# Rodar no Pico W com a biblioteca umqtt de qualquer projeto:
+#   mpremote cp -r rele_control/umqtt : + run benchmarks/bench_pid.py
+
+import gc
+import random
+from utime import ticks_us, ticks_diff
+from umqtt.simple import pid_gen, PidAllocator
+
+OPERACOES = 70000  # Mais que 65535, para que os ids deem a volta
+EM_VOO = 200  # Mensagens aguardando PUBACK ao mesmo tempo
+PRESOS = 20  # Ids que nunca são confirmados
+
+
+def rodar(alocar, liberar):
+    random.seed(1)
+    presos = [alocar() for _ in range(PRESOS)]
+    vivos = set(presos)
+    fila = []
+    colisoes = 0
+    gc.collect()
+    gc.disable()
+    antes = gc.mem_alloc()
+    inicio = ticks_us()
+    for _ in range(OPERACOES):
+        if len(fila) >= EM_VOO:
+            # PUBACK de uma mensagem qualquer da janela
+            k = random.getrandbits(8) % len(fila)
+            pid = fila[k]
+            fila[k] = fila[-1]
+            fila.pop()
+            vivos.discard(pid)
+            liberar(pid)
+        pid = alocar()
+        if pid in vivos:
+            colisoes += 1
+        vivos.add(pid)
+        fila.append(pid)
+    tempo = ticks_diff(ticks_us(), inicio)
+    alocado = gc.mem_alloc() - antes
+    gc.enable()
+    return colisoes, tempo, alocado
+
+
+def medir(nome, alocar, liberar):
+    colisoes, tempo, alocado = rodar(alocar, liberar)
+    print("%-12s ids repetidos em voo: %5d   us/op: %5.2f   bytes alocados/op: %5.2f" % (
+        nome, colisoes, tempo / OPERACOES, alocado / OPERACOES))
+
+
+gerador = pid_gen()
+medir("pid_gen", lambda: next(gerador), lambda pid: None)
+bitmap = PidAllocator()
+medir("PidAllocator", bitmap.alloc, bitmap.free)
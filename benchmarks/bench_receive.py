@@ -0,0 +1,113 @@
+# bench_receive.py - Leituras do socket e alocações por mensagem MQTT recebida
+#
+# Compara o caminho de recepção antigo do check_msg (read(1), Remaining Length byte a byte,
+# msg += rbytes) com o buffer de recepção atual do MQTTClient.
+#
+# Rodar no Pico W com a biblioteca umqtt de qualquer projeto:
+#   mpremote cp -r rele_control/umqtt : + run benchmarks/bench_receive.py
+
+import gc
+from umqtt.simple import MQTTClient
+
+MENSAGENS = 200
+PEDACO = 64  # Bytes entregues por leitura, como um segmento TCP pequeno
+
+
+def publish(topic, msg):
+    corpo = len(topic).to_bytes(2, "big") + topic + msg
+    return bytes([0x30, len(corpo)]) + corpo
+
+
+COMANDOS = [b"ON", b"OFF", b"TOGGLE"]
+DADOS = b"".join(publish(b"bitdoglab/rele/gpio19/set", COMANDOS[i % 3]) for i in range(MENSAGENS))
+
+
+class SocketMemoria:
+    """Socket que entrega DADOS em pedaços de até PEDACO bytes"""
+
+    def __init__(self):
+        self.pos = 0
+        self.leituras = 0
+
+    def read(self, n):
+        self.leituras += 1
+        n = min(n, PEDACO, len(DADOS) - self.pos)
+        if not n:
+            return None
+        self.pos += n
+        return DADOS[self.pos - n:self.pos]
+
+    def readinto(self, buf):
+        self.leituras += 1
+        n = min(len(buf), PEDACO, len(DADOS) - self.pos)
+        if not n:
+            return None
+        buf[:n] = DADOS[self.pos:self.pos + n]
+        self.pos += n
+        return n
+
+
+class PollVazio:
+    def poll(self, timeout):
+        return []
+
+
+def ler(sock, n):
+    # Leitura como no _read antigo
+    msg = b""
+    while len(msg) < n:
+        msg += sock.read(n - len(msg))
+    return msg
+
+
+def check_msg_antigo(sock, cb):
+    op = ler(sock, 1)[0]
+    sz = 0
+    sh = 0
+    while 1:
+        b = ler(sock, 1)[0]
+        sz |= (b & 0x7f) << sh
+        if not b & 0x80:
+            break
+        sh += 7
+    topic_len = int.from_bytes(ler(sock, 2), "big")
+    topic = ler(sock, topic_len)
+    sz -= topic_len + 2
+    msg = ler(sock, sz) if sz else b""
+    cb(topic, msg, bool(op & 1), bool(op & 8))
+
+
+def callback(topic, msg, retained, dup):
+    pass
+
+
+def medir(nome, rodar):
+    sock = SocketMemoria()
+    gc.collect()
+    gc.disable()
+    antes = gc.mem_alloc()
+    rodar(sock)
+    alocado = gc.mem_alloc() - antes
+    gc.enable()
+    print("%-8s leituras/msg: %5.2f   bytes alocados/msg: %6.1f" % (
+        nome, sock.leituras / MENSAGENS, alocado / MENSAGENS))
+
+
+def antigo(sock):
+    for _ in range(MENSAGENS):
+        check_msg_antigo(sock, callback)
+
+
+def atual(sock):
+    cliente.sock = sock
+    cliente.poller_r = PollVazio()
+    while sock.pos < len(DADOS):
+        cliente.check_msg()
+
+
+cliente = MQTTClient("bench", "localhost")
+cliente.set_callback(callback)
+
+print("%d mensagens de %d bytes, %d bytes por leitura do socket" % (MENSAGENS, len(DADOS) // MENSAGENS, PEDACO))
+medir("antigo", antigo)
+medir("atual", atual)
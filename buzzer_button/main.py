@@ -3,7 +3,8 @@
 import network
 import time
 from machine import Pin, PWM
-from umqtt.simple import MQTTClient
+from umqtt.simple import MQTTClient, MQTTException
+from umqtt.scheduler import OutboundScheduler, CONTROL, EVENT
 import json
 
 # Informações do WiFi
@@ -48,6 +49,13 @@ DEBOUNCE_MS = 200 # 200 milissegundos
 
 # Cliente MQTT (declarado globalmente para ser acessível nas interrupções)
 client = None
+# Fila de publicação com prioridades: estado do buzzer (CONTROL) antes dos botões (EVENT),
+# com limite de taxa para que um botão preso não inunde o broker
+agendador = None
+# Eventos dos botões anotados pela interrupção e publicados pelo loop principal, para que a
+# interrupção nunca mexa no socket nem nas filas do agendador no meio de um wait() ou service()
+eventos_botoes = []
+MAX_EVENTOS = 16
 
 # Função para conectar ao Wi-Fi
 def connect_wifi():
@@ -72,7 +80,7 @@ def connect_wifi():
 
 # Handler de interrupção para os botões
 def button_handler(pin):
-    global client, last_press_time
+    global last_press_time
     button_id = ""
     topic = ""
     current_time = time.ticks_ms()
@@ -98,17 +106,14 @@ def button_handler(pin):
     state_payload = "ON" if pin.value() == 0 else "OFF"
     print(f"Botão {button_id} Pressionado. Estado: {pin.value()} -> Payload: {state_payload}")
     
-    if client and topic:
-        try:
-            client.publish(topic, state_payload, retain=False) # Botões são eventos, retain=False é comum
-            # Para Home Assistant, é melhor enviar ON e OFF separados.
-            # Se pressionado (pin.value() == 0), envia ON.
-            # O Home Assistant pode precisar de uma automação para resetar para OFF ou usar `off_delay`.
-            # Alternativamente, o Pico pode enviar OFF após um tempo, ou na liberação do botão.
-            # Para este exemplo, vamos enviar ON ao pressionar e OFF ao liberar (se a interrupção pegar os dois flancos)
-            # A configuração IRQ_FALLING | IRQ_RISING faz isso.
-        except Exception as e:
-            print(f"Erro ao publicar estado do botão {button_id}: {e}")
+    if topic and len(eventos_botoes) < MAX_EVENTOS:
+        eventos_botoes.append((topic, state_payload)) # Publicado pelo loop principal como EVENT, retain=False
+        # Para Home Assistant, é melhor enviar ON e OFF separados.
+        # Se pressionado (pin.value() == 0), envia ON.
+        # O Home Assistant pode precisar de uma automação para resetar para OFF ou usar `off_delay`.
+        # Alternativamente, o Pico pode enviar OFF após um tempo, ou na liberação do botão.
+        # Para este exemplo, vamos enviar ON ao pressionar e OFF ao liberar (se a interrupção pegar os dois flancos)
+        # A configuração IRQ_FALLING | IRQ_RISING faz isso.
 
 # Configura as interrupções para os botões (detecta tanto ao pressionar quanto ao soltar)
 button_a.irq(trigger=Pin.IRQ_FALLING | Pin.IRQ_RISING, handler=button_handler)
@@ -145,14 +150,14 @@ def control_buzzer(command):
                 buzzer_state = "OFF"
                 print("Buzzer OFF (comando)")
         
-        if client:
-            client.publish(MQTT_TOPIC_BUZZER_STATE, buzzer_state, retain=True)
+        if agendador:
+            agendador.publish(MQTT_TOPIC_BUZZER_STATE, buzzer_state, retain=True, prio=CONTROL)
             
     except Exception as e:
         print(f"Erro ao controlar buzzer: {e}")
         buzzer_pwm.duty_u16(0) # Garante que o buzzer desligue em caso de erro
         buzzer_state = "OFF"
-        if client: client.publish(MQTT_TOPIC_BUZZER_STATE, buzzer_state, retain=True)
+        if agendador: agendador.publish(MQTT_TOPIC_BUZZER_STATE, buzzer_state, retain=True, prio=CONTROL)
 
 # Callback para mensagens MQTT (para o buzzer)
 def mqtt_callback(topic, msg, retained=False, dup=False):
@@ -162,7 +167,7 @@ def mqtt_callback(topic, msg, retained=False, dup=False):
 
 # Função para conectar ao Broker MQTT
 def connect_mqtt():
-    global client
+    global client, agendador
     client = MQTTClient(MQTT_CLIENT_ID, MQTT_BROKER, port=MQTT_PORT, user=MQTT_USER, password=MQTT_PASSWORD)
     client.set_callback(mqtt_callback)
     try:
@@ -176,6 +181,10 @@ def connect_mqtt():
         client.publish(MQTT_TOPIC_BUTTON_A_STATE, "OFF", retain=False)
         client.publish(MQTT_TOPIC_BUTTON_B_STATE, "OFF", retain=False)
         client.publish(MQTT_TOPIC_BUTTON_C_STATE, "OFF", retain=False)
+        if agendador is None:
+            agendador = OutboundScheduler(client)
+        else:
+            agendador.client = client
         return client
     except Exception as e:
         print(f"Falha ao conectar ou inscrever no broker MQTT: {e}")
@@ -198,9 +207,15 @@ def run():
     print("Aguardando interações (botões) e comandos MQTT (buzzer)...")
     while True:
         try:
-            mqtt_client.check_msg() # Processa mensagens MQTT para o buzzer
-            time.sleep(0.1) # Pequena pausa
-        except OSError as e:
+            mqtt_client.wait(100) # Espera até 100 ms por mensagens MQTT para o buzzer, tratando-as assim que chegam
+            # Passa para o agendador os eventos anotados pela interrupção (pop e append não se interrompem)
+            while eventos_botoes:
+                topic, state_payload = eventos_botoes.pop(0)
+                agendador.publish(topic, state_payload, retain=False, prio=EVENT)
+            agendador.service() # Envia publicações retidas pelo limite de taxa
+        except (OSError, MQTTException) as e:
+            # O wait() e o service() escrevem no socket: num link morto acusam a falha com MQTTException
+            # (sem conexão, timeout ou resposta inválida), que também precisa reconectar
             print(f"Erro de comunicação MQTT: {e}. Tentando reconectar...")
             time.sleep(5)
             if mqtt_client: mqtt_client.disconnect()
@@ -0,0 +1,119 @@
+from utime import ticks_ms, ticks_diff
+
+# Priority classes, served in this order
+CONTROL = 0  # State confirmations and availability
+EVENT = 1  # Button presses and other discrete events
+TELEMETRY = 2  # Periodic sensor readings
+
+# Policies for a message arriving at a full queue
+DROP_OLDEST = 0
+COALESCE = 1  # Also replaces a queued message to the same topic instead of queueing a second one
+
+
+class OutboundScheduler:
+
+    def __init__(self, client, classes=None):
+        """
+        Outbound scheduler with one queue and one token bucket per priority class.
+
+        Queued messages are sent highest priority first, each class limited by its own rate,
+        so a burst of telemetry or a stuck button can't delay state confirmations or flood the broker.
+
+        :param client: Connected client. May be replaced later through the client attribute, e.g. after a reconnect.
+        :type client: MQTTClient
+        :param classes: One tuple (rate, burst, queue_len, policy) per priority class CONTROL, EVENT and TELEMETRY.
+                        rate - sustained messages per second, burst - messages that can be sent at once,
+                        queue_len - messages kept while the class is rate limited, policy - DROP_OLDEST or COALESCE.
+        :type classes: list
+        """
+        if classes is None:
+            classes = [(20, 10, 8, COALESCE), (5, 5, 8, DROP_OLDEST), (1, 2, 4, COALESCE)]
+        self.client = client
+        self.classes = classes
+        self.queues = [[] for _ in classes]
+        # Tokens are kept in thousandths so that they can be refilled per millisecond with integers.
+        self.tokens = [burst * 1000 for rate, burst, queue_len, policy in classes]
+        self.last_refill = ticks_ms()
+        self._taken = [0] * len(classes)  # Messages of each class published by the running service()
+        self.stats = {'sent': [0] * len(classes), 'dropped': [0] * len(classes), 'coalesced': [0] * len(classes)}
+
+    def publish(self, topic, msg, retain=False, qos=0, prio=TELEMETRY):
+        """
+        Queues a message and sends whatever the rate limits allow right away.
+
+        :param topic: Topic you wish to publish to. With the COALESCE policy messages are matched by this object,
+                      so pass the same str or Topic every time.
+        :type topic: byte or Topic
+        :param msg: Message to publish to topic.
+        :type msg: byte
+        :param retain: Have the MQTT broker retain the message.
+        :type retain: bool
+        :param qos: Sets quality of service level. Accepts values 0 to 1.
+        :type qos: int
+        :param prio: Priority class: CONTROL, EVENT or TELEMETRY
+        :type prio: int
+        :return: Number of messages sent.
+        :rtype: int
+        """
+        q = self.queues[prio]
+        rate, burst, queue_len, policy = self.classes[prio]
+        if policy == COALESCE:
+            for m in q:
+                if m[0] == topic:
+                    m[1] = msg
+                    m[2] = retain
+                    m[3] = qos
+                    self.stats['coalesced'][prio] += 1
+                    return self.service()
+        if len(q) >= queue_len:
+            q.pop(0)
+            self.stats['dropped'][prio] += 1
+        q.append([topic, msg, retain, qos])
+        return self.service()
+
+    def _refill(self):
+        now = ticks_ms()
+        elapsed = ticks_diff(now, self.last_refill)
+        if elapsed <= 0:
+            return
+        self.last_refill = now
+        for i, (rate, burst, queue_len, policy) in enumerate(self.classes):
+            self.tokens[i] = min(self.tokens[i] + elapsed * rate, burst * 1000)
+
+    def service(self):
+        """
+        Sends queued messages allowed by the rate limits, highest priority first, in a single write.
+        Call it from the main loop to drain messages held back by the rate limits.
+
+        :return: Number of messages sent.
+        :rtype: int
+        """
+        self._refill()
+        taken = self._taken
+        self.client.cork()
+        try:
+            for prio, q in enumerate(self.queues):
+                k = 0
+                while k < len(q) and self.tokens[prio] - k * 1000 >= 1000:
+                    m = q[k]
+                    self.client.publish(m[0], m[1], m[2], m[3])
+                    k += 1
+                taken[prio] = k
+        finally:
+            self.client.flush()
+        # Messages leave the queues only once written: if the flush fails they are sent again next time.
+        n = 0
+        for prio, k in enumerate(taken):
+            if k:
+                del self.queues[prio][:k]
+                self.tokens[prio] -= k * 1000
+                self.stats['sent'][prio] += k
+                n += k
+        return n
+
+    def pending(self):
+        """
+        :return: Number of queued messages.
+        :rtype: int
+        """
+        return sum(len(q) for q in self.queues)
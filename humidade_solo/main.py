@@ -125,7 +125,16 @@ while True:
             print("  ⚠️ Nenhuma alteração. MQTT não enviado.")
 
         print("-" * 30)
-        time.sleep(3)
+        if mqtt_client:
+            # Aguarda o próximo ciclo pelo cliente: ele envia o PINGREQ do keepalive sozinho
+            # e acusa a queda do broker sem esperar a próxima publicação
+            fim = time.ticks_add(time.ticks_ms(), 3000)
+            restante = 3000
+            while restante > 0:
+                mqtt_client.wait(restante)
+                restante = time.ticks_diff(fim, time.ticks_ms())
+        else:
+            time.sleep(3)
 
     except Exception as e:
         print(f"❌ Erro inesperado: {e}")
@@ -136,4 +145,5 @@ while True:
         except Exception as e_disc:
             print(f"Erro ao desconectar: {e_disc}")
         mqtt_client = None
+        ultimo_estado_digital = None  # Publica o estado atual assim que reconectar
         time.sleep(5)
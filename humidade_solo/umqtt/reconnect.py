@@ -0,0 +1,189 @@
+from utime import ticks_ms, ticks_diff, ticks_add, sleep_ms
+from urandom import getrandbits
+from umqtt.simple import MQTTException
+
+# Connection states, see Reconnector.state
+WIFI_DOWN = 0
+BROKER_DOWN = 1
+CONNECTED = 2
+
+
+class Reconnector:
+
+    def __init__(self, client, wlan=None, ssid=None, password=None, base_ms=1000, cap_ms=60000,
+                 wifi_timeout_ms=20000, session_expiry=None):
+        """
+        Keeps a client connected, retrying with capped exponential backoff and jitter.
+
+        The delay before a retry is chosen at random between half and all of min(cap_ms, base_ms * 2^n), n being
+        the number of failed attempts, so devices that lost the same broker don't all come back at the same moment.
+        Wi-Fi and broker failures are retried separately: while the Wi-Fi is down only the Wi-Fi is retried, and the
+        broker backoff starts again from base_ms once it is up.
+
+        :param client: Client to keep connected. Its callbacks, routes and buffers are kept across reconnects.
+        :type client: MQTTClient
+        :param wlan: Station interface. None - the Wi-Fi is not checked.
+        :type wlan: network.WLAN
+        :param ssid: Network joined when the Wi-Fi is down. None - wait for the interface to reconnect on its own.
+        :type ssid: str
+        :param password: Network password.
+        :type password: str
+        :param base_ms: Delay before the first retry.
+        :type base_ms: int
+        :param cap_ms: Longest delay between retries.
+        :type cap_ms: int
+        :param wifi_timeout_ms: Time to wait for the Wi-Fi to come up in one attempt.
+        :type wifi_timeout_ms: int
+        :param session_expiry: Connect with resume(session_expiry), keeping the session on the broker.
+                               None - connect() with a clean session.
+        :type session_expiry: int
+        """
+        self.client = client
+        self.wlan = wlan
+        self.ssid = ssid
+        self.password = password
+        self.base_ms = base_ms
+        self.cap_ms = cap_ms
+        self.wifi_timeout_ms = wifi_timeout_ms
+        self.session_expiry = session_expiry
+        self.cb = None
+        self.state = BROKER_DOWN
+        self.tries = 0  # Failed attempts since the state changed
+        self.next_try = ticks_ms()  # The first connection is attempted right away
+        self.down_since = None  # Time failed() was called, None until the first connection is lost
+        # last_ms, max_ms and total_ms / reconnects: time from failed() to the connection being back
+        self.stats = {'attempts': 0, 'wifi_drops': 0, 'broker_drops': 0, 'reconnects': 0,
+                      'last_ms': 0, 'max_ms': 0, 'total_ms': 0}
+
+    def set_callback(self, f):
+        """
+        Sets the function called after every successful connection, to restore what the broker does not keep:
+        subscriptions of a clean session, availability and state messages, Home Assistant discovery.
+        If it raises OSError or MQTTException the attempt counts as failed.
+
+        :param f: function(client, present), present being the session flag returned by connect().
+        :type f: function
+        :return: None
+        """
+        self.cb = f
+
+    def failed(self):
+        """
+        Reports that the client raised, e.g. in publish() or check_msg(). Closes the connection and schedules
+        the first retry.
+
+        :return: None
+        """
+        try:
+            self.client.disconnect()
+        except (OSError, MQTTException):
+            pass
+        if self.state == CONNECTED:
+            self.down_since = ticks_ms()
+            if self.wlan is not None and not self.wlan.isconnected():
+                self.stats['wifi_drops'] += 1
+                self.state = WIFI_DOWN
+            else:
+                self.stats['broker_drops'] += 1
+                self.state = BROKER_DOWN
+            self.tries = 0
+            self._backoff()
+
+    def _backoff(self):
+        """
+        Private class method. Schedules the next attempt after a random delay and doubles the range for the one after.
+
+        :return: None
+        """
+        d = min(self.cap_ms, self.base_ms << self.tries)
+        if d < self.cap_ms:
+            self.tries += 1
+        half = d // 2
+        self.next_try = ticks_add(ticks_ms(), half + ((getrandbits(16) * (d - half)) >> 16))
+
+    def _set_state(self, state):
+        if state != self.state:
+            self.state = state
+            self.tries = 0
+
+    def _join_wifi(self):
+        """
+        Private class method. Joins the network and waits for it up to wifi_timeout_ms.
+
+        :return: True if the Wi-Fi is up
+        :rtype: bool
+        """
+        if self.ssid is not None:
+            self.wlan.active(True)
+            self.wlan.connect(self.ssid, self.password)
+        start = ticks_ms()
+        while not self.wlan.isconnected():
+            if self.wlan.status() < 0 or ticks_diff(ticks_ms(), start) >= self.wifi_timeout_ms:
+                return False  # Wrong password, network not found or timeout
+            sleep_ms(100)
+        return True
+
+    def step(self):
+        """
+        Attempts to connect if the connection is down and the retry delay has passed. Does not wait otherwise,
+        so the main loop can keep running while offline.
+
+        :return: True if the client is connected
+        :rtype: bool
+        """
+        if self.state == CONNECTED:
+            return True
+        if ticks_diff(self.next_try, ticks_ms()) > 0:
+            return False
+        self.stats['attempts'] += 1
+        if self.wlan is not None and not self.wlan.isconnected():
+            self._set_state(WIFI_DOWN)
+            if not self._join_wifi():
+                self._backoff()
+                return False
+        self._set_state(BROKER_DOWN)
+        try:
+            if self.session_expiry is None:
+                present = self.client.connect()
+            else:
+                present = self.client.resume(self.session_expiry)
+            if self.cb:
+                self.cb(self.client, present)
+        except (OSError, MQTTException):
+            try:
+                self.client.disconnect()
+            except (OSError, MQTTException):
+                pass
+            self._backoff()
+            return False
+        self._set_state(CONNECTED)
+        if self.down_since is not None:
+            t = ticks_diff(ticks_ms(), self.down_since)
+            self.down_since = None
+            self.stats['reconnects'] += 1
+            self.stats['last_ms'] = t
+            self.stats['total_ms'] += t
+            if t > self.stats['max_ms']:
+                self.stats['max_ms'] = t
+        return True
+
+    def ensure(self, timeout_ms=-1):
+        """
+        Sleeps and retries until the client is connected or the timeout expires.
+
+        :param timeout_ms: Maximum time to wait in milliseconds. -1 - no limit.
+        :type timeout_ms: int
+        :return: True if the client is connected
+        :rtype: bool
+        """
+        start = ticks_ms()
+        while not self.step():
+            d = ticks_diff(self.next_try, ticks_ms())
+            if timeout_ms >= 0:
+                left = timeout_ms - ticks_diff(ticks_ms(), start)
+                if left <= 0:
+                    return False
+                d = min(d, left)
+            if d > 0:
+                sleep_ms(d)
+        return True
@@ -46,6 +46,7 @@ button = Pin(PIN_BOTAO, Pin.IN, Pin.PULL_UP)
 
 # Instância do client MQTT
 mqtt_client = None
+inscrito = False  # A inscrição é feita uma vez; nas reconexões o cliente só a refaz se o broker perdeu a sessão
 
 def conectar_wifi():
     """Conecta ao WiFi"""
@@ -80,7 +81,7 @@ def conectar_wifi():
     led.value(0)
     return True
 
-def mqtt_callback(topic, msg):
+def mqtt_callback(topic, msg, *args):
     """Callback para mensagens MQTT recebidas"""
     topic = topic.decode('utf-8')
     msg = msg.decode('utf-8')
@@ -99,23 +100,32 @@ def mqtt_callback(topic, msg):
 
 def iniciar_mqtt():
     """Inicializa a conexão MQTT"""
-    global mqtt_client
+    global mqtt_client, inscrito
     print("Iniciando MQTT...")
     
     try:
-        mqtt_client = MQTTClient(
-            MQTT_CLIENT_ID, 
-            MQTT_SERVER,
-            port=MQTT_PORT,
-            user=MQTT_USER, 
-            password=MQTT_PASS,
-            keepalive=60
-        )
-        mqtt_client.set_callback(mqtt_callback)
-        mqtt_client.connect()
+        # O cliente é reaproveitado nas reconexões para não perder a fila offline
+        if mqtt_client is None:
+            mqtt_client = MQTTClient(
+                MQTT_CLIENT_ID, 
+                MQTT_SERVER,
+                port=MQTT_PORT,
+                user=MQTT_USER, 
+                password=MQTT_PASS,
+                keepalive=60  # wait() e process() enviam o PINGREQ e acusam a queda do link sozinhos
+            )
+            mqtt_client.set_callback(mqtt_callback)
+            # Mensagens publicadas sem conexão ficam numa fila de tamanho fixo e são enviadas
+            # em ordem após a reconexão; dos estados só o último é guardado
+            mqtt_client.set_offline_buffer(latest_only=[MQTT_TOPIC_STATE, MQTT_TOPIC_LED_STATE])
+        # Sessão persistente: o broker guarda a inscrição e os comandos QoS 1 enviados durante quedas
+        mqtt_client.resume()
         
-        # Inscrever-se no tópico de controle do LED
-        mqtt_client.subscribe(MQTT_TOPIC_LED_SET)
+        # Inscrever-se no tópico de controle do LED só na primeira conexão: depois o resume()
+        # a refaz sozinho, e só se o broker tiver perdido a sessão
+        if not inscrito:
+            mqtt_client.subscribe(MQTT_TOPIC_LED_SET, qos=1)
+            inscrito = True
         
         # Publica que o dispositivo está online
         publicar_mqtt(MQTT_TOPIC_AVAILABILITY, b"online", retain=True)
@@ -135,15 +145,31 @@ def publicar_mqtt(topic, payload, retain=False):
     except Exception as e:
         print("Erro ao publicar:", e)
         try:
-            # Tenta reconectar
-            mqtt_client.connect()
-            # Inscrever-se novamente após reconexão
-            mqtt_client.subscribe(MQTT_TOPIC_LED_SET)
-            mqtt_client.publish(topic, payload, retain=retain)
-            print("Reconectado e publicado com sucesso")
+            # Tenta reconectar; a inscrição só é refeita se o broker tiver perdido a sessão
+            # e a mensagem, guardada na fila offline, é enviada logo em seguida
+            mqtt_client.resume()
+            print("Reconectado; mensagem na fila para envio")
             return True
         except:
-            print("Falha na reconexão MQTT")
+            print("Falha na reconexão MQTT; mensagem guardada na fila offline")
+            return False
+
+def publicar_varios_mqtt(mensagens):
+    """Publica várias mensagens MQTT num único envio"""
+    try:
+        mqtt_client.publish_many(mensagens)
+        print(f"Publicadas {len(mensagens)} mensagens")
+        return True
+    except Exception as e:
+        print("Erro ao publicar:", e)
+        try:
+            # Tenta reconectar; a inscrição só é refeita se o broker tiver perdido a sessão
+            # e as mensagens, guardadas na fila offline, são enviadas logo em seguida
+            mqtt_client.resume()
+            print("Reconectado; mensagens na fila para envio")
+            return True
+        except:
+            print("Falha na reconexão MQTT; mensagens guardadas na fila offline")
             return False
 
 def configurar_ha_discovery():
@@ -200,10 +226,16 @@ else:
         publicar_mqtt(MQTT_TOPIC_LED_STATE, b"OFF")
         
         # Loop principal
+        proximo_ciclo = time.ticks_ms()
         while True:
-            # Verifica mensagens MQTT pendentes
+            # Dorme até o próximo ciclo, acordando para tratar comandos MQTT assim que chegam
             try:
-                mqtt_client.check_msg()
+                restante = time.ticks_diff(proximo_ciclo, time.ticks_ms())
+                while restante > 0:
+                    mqtt_client.wait(restante)
+                    restante = time.ticks_diff(proximo_ciclo, time.ticks_ms())
+                mqtt_client.process()
+                proximo_ciclo = time.ticks_add(time.ticks_ms(), UPDATE_INTERVAL)
             except Exception as e:
                 print("Erro ao verificar mensagens MQTT:", e)
                 # Tenta reconectar ao MQTT
@@ -245,15 +277,14 @@ else:
             if time_counter < HEARTBEAT_INTERVAL:
                 time_counter += 1
             else:
-                # Enviar estado atual para manter o sensor ativo no HA
-                publicar_mqtt(MQTT_TOPIC_STATE, b"ON" if estado_interruptor else b"OFF")
+                # Envia num único pacote TCP:
+                # - estado atual para manter o sensor ativo no HA
+                # - estado atual do LED
+                # - sinal de disponibilidade para manter o status online
+                publicar_varios_mqtt([
+                    (MQTT_TOPIC_STATE, b"ON" if estado_interruptor else b"OFF"),
+                    (MQTT_TOPIC_LED_STATE, b"ON" if led_externo.value() else b"OFF"),
+                    (MQTT_TOPIC_AVAILABILITY, b"online", True),
+                ])
                 
-                # Enviar também o estado atual do LED
-                publicar_mqtt(MQTT_TOPIC_LED_STATE, b"ON" if led_externo.value() else b"OFF")
-                
-                # Enviar sinal de disponibilidade para manter o status online
-                publicar_mqtt(MQTT_TOPIC_AVAILABILITY, b"online", retain=True)
-                
-                time_counter = 0
-            
-            time.sleep(UPDATE_INTERVAL / 1000)  # Converte ms para segundos
\ No newline at end of file
+                time_counter = 0
\ No newline at end of file
@@ -2,7 +2,9 @@
 import network
 import time
 from machine import ADC # Importa a classe ADC
-from umqtt.simple import MQTTClient
+from umqtt.simple import MQTTClient, MQTTException
+from umqtt.flashqueue import FlashQueue
+from umqtt.reconnect import Reconnector
 
 # Configurações de Rede Wi-Fi
 WIFI_SSID = "SEU_NOME_DE_REDE_WIFI"
@@ -26,38 +28,19 @@ INTERVALO_LEITURA = 60
 # O ADC(4) é o canal para o sensor de temperatura interno do RP2040
 sensor_temp_adc = ADC(4)
 
-# Função para conectar ao Wi-Fi
-def connect_wifi():
-    wlan = network.WLAN(network.STA_IF)
-    wlan.active(True)
-    if not wlan.isconnected():
-        print(f"Conectando à rede {WIFI_SSID}...")
-        wlan.connect(WIFI_SSID, WIFI_PASSWORD)
-        timeout_wifi = 0
-        while not wlan.isconnected() and timeout_wifi < 20:
-            print(".", end="")
-            time.sleep(1)
-            timeout_wifi += 1
-        if wlan.isconnected():
-            print(f"\nConectado! Endereço IP: {wlan.ifconfig()[0]}")
-        else:
-            print("\nFalha ao conectar ao Wi-Fi. Verifique as credenciais e a rede.")
-            return None
-    else:
-        print(f"Já conectado à rede {WIFI_SSID}. IP: {wlan.ifconfig()[0]}")
-    return wlan
+# Fila de leituras na flash: as leituras não enviadas são gravadas na hora (ver flush() no loop),
+# sobrevivem a um reset ou queda de energia e são enviadas em ordem, da mais antiga para a mais nova,
+# quando o broker volta
+fila_temp = FlashQueue(MQTT_TOPIC_TEMP, path="/fila_temp")
 
-# Função para conectar ao Broker MQTT
-def connect_mqtt():
-    client = MQTTClient(MQTT_CLIENT_ID, MQTT_BROKER, port=MQTT_PORT, user=MQTT_USER, password=MQTT_PASSWORD)
-    try:
-        client.connect()
-        print(f"Conectado ao broker MQTT: {MQTT_BROKER}")
-        client.publish(MQTT_TOPIC_STATUS, "online", retain=True)
-        return client
-    except Exception as e:
-        print(f"Falha ao conectar ao broker MQTT: {e}")
-        return None
+# Chamado pelo reconectador a cada conexão ao broker
+def restaurar_mqtt(client, present):
+    print(f"Conectado ao broker MQTT: {MQTT_BROKER}")
+    client.publish(MQTT_TOPIC_STATUS, "online", retain=True)
+    # Envia as leituras feitas enquanto estava sem conexão
+    enviados = fila_temp.replay(client, qos=1)
+    if enviados:
+        print(f"{enviados} leitura(s) guardada(s) enviada(s).")
 
 # Função para ler e converter a temperatura do sensor interno
 def read_internal_temp():
@@ -75,53 +58,57 @@ def read_internal_temp():
 
 # Loop principal
 def run():
-    wlan = connect_wifi()
-    if not wlan or not wlan.isconnected():
-        print("Não foi possível conectar ao Wi-Fi. Reiniciando em 60 segundos...")
-        time.sleep(60)
-        machine.reset()
-        return
-
-    mqtt_client = connect_mqtt()
-    if not mqtt_client:
-        print("Não foi possível conectar ao MQTT. Reiniciando em 60 segundos...")
-        time.sleep(60)
-        machine.reset()
-        return
+    wlan = network.WLAN(network.STA_IF)
+    wlan.active(True)
+    # Com keepalive, o wait() do loop envia PINGREQ e acusa um link morto em vez de escrever nele para sempre
+    mqtt_client = MQTTClient(MQTT_CLIENT_ID, MQTT_BROKER, port=MQTT_PORT, user=MQTT_USER, password=MQTT_PASSWORD,
+                             keepalive=60)
+    # Em vez de reiniciar a placa, tenta de novo com esperas de 1 s a 60 s sorteadas, tratando
+    # Wi-Fi e broker em separado; as leituras continuam indo para a fila enquanto isso
+    reconectador = Reconnector(mqtt_client, wlan, WIFI_SSID, WIFI_PASSWORD)
+    reconectador.set_callback(restaurar_mqtt)
 
     print("Monitoramento de temperatura interna iniciado...")
     last_read_time = 0
     while True:
         try:
+            conectado = reconectador.step()
             current_time = time.time()
             if (current_time - last_read_time) >= INTERVALO_LEITURA:
                 temperatura = read_internal_temp()
+                # Marca a leitura antes do envio: se a publicação falhar, ela já está na fila
+                last_read_time = current_time
 
                 if temperatura is not None:
                     print(f"Temperatura Interna do Pico: {temperatura:.2f}°C")
-                    mqtt_client.publish(MQTT_TOPIC_TEMP, str(round(temperatura, 2)))
-                    print("Dado de temperatura interna publicado via MQTT.")
+                    fila_temp.put(str(round(temperatura, 2)))
+                    if conectado:
+                        # QoS 1: cada leitura só sai da fila quando o broker confirma com PUBACK
+                        enviados = fila_temp.replay(mqtt_client, qos=1)
+                        print(f"Dado de temperatura interna publicado via MQTT ({enviados} leitura(s) enviada(s)).")
+                    else:
+                        print(f"Sem conexão: leitura guardada na fila ({fila_temp.pending()} pendente(s)).")
+                    # Com uma leitura por minuto, esperar o lote de 8 da fila deixaria os últimos minutos
+                    # só na RAM: o que não foi confirmado vai para a flash já
+                    fila_temp.flush()
                 else:
                     print("Falha ao ler temperatura interna.")
                     # Opcional: publicar um status de erro do sensor
                     # mqtt_client.publish(MQTT_TOPIC_STATUS, "error_reading_sensor", retain=True)
-                
-                last_read_time = current_time
             
-            time.sleep(1)
+            if conectado:
+                mqtt_client.wait(1000)
+            else:
+                time.sleep(1)
 
-        except OSError as e:
+        except (OSError, MQTTException) as e:
             print(f"Erro de comunicação MQTT: {e}")
-            print("Tentando reconectar ao MQTT...")
-            if mqtt_client: mqtt_client.disconnect()
-            mqtt_client = connect_mqtt()
-            if not mqtt_client:
-                print("Falha ao reconectar ao MQTT. Reiniciando o dispositivo...")
-                time.sleep(10)
-                machine.reset()
-            else:
-                print("Reconectado ao MQTT com sucesso.")
-                mqtt_client.publish(MQTT_TOPIC_STATUS, "online", retain=True)
+            print("Tentando reconectar...")
+            try:
+                fila_temp.flush()  # A leitura que estava sendo enviada continua na fila
+            except OSError as e:
+                print(f"Erro ao gravar a fila na flash: {e}")
+            reconectador.failed()
         except Exception as e:
             print(f"Erro inesperado: {e}")
             time.sleep(10)
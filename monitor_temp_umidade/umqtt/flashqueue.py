@@ -0,0 +1,267 @@
+import uos
+from utime import ticks_ms, ticks_diff
+
+
+class FlashQueue:
+
+    def __init__(self, topic, path="/fila", record_size=32, batch=8, segment_records=256, max_segments=16):
+        """
+        Store-and-forward queue for the messages of one topic, kept on the flash filesystem across resets.
+
+        Messages are fixed-size records appended to segment files and sent oldest first by replay(). A read cursor
+        is kept in a file next to the segments, and segments are deleted once sent. Records are first collected
+        in RAM and written batch at a time, to limit flash wear, so up to batch records are lost on a power cut
+        or reset. Call flush() where they must survive it, e.g. after each put() while offline when messages are
+        minutes apart. While replay() keeps up, records never reach the flash at all.
+
+        :param topic: Topic the messages are published to.
+        :type topic: byte or str or Topic
+        :param path: Directory of the segment and cursor files.
+        :type path: str
+        :param record_size: Bytes per record, the largest message is one byte shorter.
+        :type record_size: int
+        :param batch: Records kept in RAM before they are written to flash.
+        :type batch: int
+        :param segment_records: Records per segment file.
+        :type segment_records: int
+        :param max_segments: Segments kept at most. When they are all in use, the oldest one is dropped.
+        :type max_segments: int
+        """
+        assert record_size <= 256
+        self.topic = topic
+        self.path = path
+        self.size = record_size
+        self.seg_records = segment_records
+        self.max_segments = max_segments
+        self.buf = bytearray(batch * record_size)  # Records not written to flash yet, from bhead to btail
+        self.mv = memoryview(self.buf)
+        self.bhead = 0
+        self.btail = 0
+        self.rec = bytearray(record_size)  # Record read from flash
+        self.rmv = memoryview(self.rec)
+        self.stats = {'queued': 0, 'sent': 0, 'dropped': 0, 'flash_writes': 0}
+        try:
+            uos.mkdir(path)
+        except OSError:
+            pass  # Already exists
+        segs = sorted(int(n[:-2]) for n in uos.listdir(path) if n.endswith('.q'))
+        self.wseg = segs[-1] if segs else 0  # Segment being written
+        self.wpos = 0  # Records in it
+        if segs:
+            n = uos.stat(self._seg(self.wseg))[6]
+            if n % record_size:
+                # Reset in the middle of a write: the partial record is left behind, replay() stops before it
+                self.wseg += 1
+            else:
+                self.wpos = n // record_size
+        self.rseg = segs[0] if segs else self.wseg  # Next record to send
+        self.rpos = 0
+        try:
+            with open(path + "/cursor") as f:
+                seg, pos = [int(v) for v in f.read().split()]
+            if self.rseg <= seg <= self.wseg:
+                self.rseg = seg
+                self.rpos = min(pos, self.wpos) if seg == self.wseg else pos
+        except (OSError, ValueError):
+            pass  # No cursor yet: start from the oldest segment
+
+    def _seg(self, n):
+        return "%s/%d.q" % (self.path, n)
+
+    def _save_cursor(self):
+        with open(self.path + "/cursor", "w") as f:
+            f.write("%d %d" % (self.rseg, self.rpos))
+
+    def _remove(self, n):
+        try:
+            uos.remove(self._seg(n))
+        except OSError:
+            pass
+
+    def put(self, msg):
+        """
+        Queues a message. It is only kept in RAM until the batch is full or flush() is called.
+
+        :param msg: Message, shorter than record_size.
+        :type msg: byte or str
+        :return: None
+        """
+        if isinstance(msg, str):
+            msg = msg.encode()
+        assert len(msg) < self.size
+        if self.btail * self.size == len(self.buf):
+            self.flush()
+        o = self.btail * self.size
+        self.buf[o] = len(msg)
+        self.buf[o + 1:o + 1 + len(msg)] = msg
+        self.btail += 1
+        self.stats['queued'] += 1
+
+    def flush(self):
+        """
+        Writes the records kept in RAM to flash, one write per segment.
+
+        :return: None
+        """
+        while self.bhead < self.btail:
+            if self.wpos >= self.seg_records:
+                self._next_segment()
+            n = min(self.btail - self.bhead, self.seg_records - self.wpos)
+            with open(self._seg(self.wseg), "ab") as f:
+                f.write(self.mv[self.bhead * self.size:(self.bhead + n) * self.size])
+            self.stats['flash_writes'] += 1
+            self.wpos += n
+            self.bhead += n
+        self.bhead = self.btail = 0
+
+    def _next_segment(self):
+        self.wseg += 1
+        self.wpos = 0
+        if self.wseg - self.rseg >= self.max_segments:
+            # Flash budget spent: the oldest segment is dropped
+            self.stats['dropped'] += max(self.seg_records - self.rpos, 0)
+            self._remove(self.rseg)
+            self.rseg += 1
+            self.rpos = 0
+            self._save_cursor()
+
+    def pending(self):
+        """
+        :return: Number of queued messages.
+        :rtype: int
+        """
+        return (self.wseg - self.rseg) * self.seg_records + self.wpos - self.rpos + self.btail - self.bhead
+
+    def _advance(self, seg, pos, bhead):
+        """
+        Private class method. Moves the read cursor to a position reached by replay(), deleting the segments passed.
+        """
+        while self.rseg < seg:
+            self._remove(self.rseg)
+            self.rseg += 1
+        self.rpos = pos
+        self.bhead = bhead
+        if self.bhead == self.btail:
+            self.bhead = self.btail = 0
+
+    def replay(self, client, qos=0, limit=None, window=16, timeout_ms=5000):
+        """
+        Publishes queued messages oldest first, those on flash before those still in RAM.
+
+        With qos=0 a message counts as sent once publish() returns, so messages written into a connection that
+        is already dead are lost. With qos=1 a message is only removed once the server acknowledged it: after
+        each window of messages replay() waits for their PUBACKs and stops at the first one missing, which
+        the next call sends again. A message publish() returns no pid for counts as sent: the client skipped it
+        as a repeated value (set_publish_cache()) or took it into its offline buffer, which sends it later.
+        If publish() raises, the message stays queued and the error is passed on.
+        The cursor is saved once per call.
+
+        :param client: Connected client.
+        :type client: MQTTClient
+        :param qos: QoS of the published messages.
+        :type qos: int
+        :param limit: Maximum number of messages to publish. None - no limit.
+        :type limit: int
+        :param window: qos=1 only. Messages published before waiting for their PUBACKs.
+        :type window: int
+        :param timeout_ms: qos=1 only. Time to wait for the PUBACKs of a window.
+        :type timeout_ms: int
+        :return: Number of messages sent, with qos=1 acknowledged.
+        :rtype: int
+        """
+        n = 0
+        seg, pos = self.rseg, self.rpos
+        sent = []  # (pid, seg, pos, bhead) after each message awaiting its PUBACK
+        acked = []
+        if qos:
+            prev = client.cbstat
+            # The status callback set by the application still gets every status
+            def status(pid, st):
+                if st == 1:
+                    acked.append(pid)
+                prev(pid, st)
+            client.cbstat = status
+        rs, rp, bh = self.rseg, self.rpos, self.bhead  # Next message to publish
+        try:
+            while (limit is None or n < limit) and (rs < self.wseg or rp < self.wpos):
+                end = self.seg_records if rs < self.wseg else self.wpos
+                try:
+                    f = open(self._seg(rs), "rb")
+                except OSError:
+                    end = rp  # Segment lost, skip it
+                else:
+                    with f:
+                        f.seek(rp * self.size)
+                        while rp < end and (limit is None or n < limit):
+                            if f.readinto(self.rec) != self.size:
+                                end = rp  # Partial record left by a reset
+                                break
+                            rp += 1
+                            if self.rec[0]:
+                                pid = client.publish(self.topic, self.rmv[1:1 + self.rec[0]], qos=qos)
+                                n += 1
+                                if not qos:
+                                    self._advance(rs, rp, bh)
+                                else:
+                                    sent.append((pid, rs, rp, bh))
+                                    if len(sent) >= window and not self._settle(client, sent, acked, timeout_ms):
+                                        return n - len(sent)
+                if rp >= end:
+                    if rs == self.wseg:
+                        if rp == self.wpos:
+                            break
+                        self.wseg += 1  # The segment being written is unreadable, continue in a new one
+                        self.wpos = 0
+                    rs += 1
+                    rp = 0
+                    if not sent:
+                        self._advance(rs, rp, bh)
+            while (limit is None or n < limit) and bh < self.btail:
+                o = bh * self.size
+                pid = client.publish(self.topic, self.mv[o + 1:o + 1 + self.buf[o]], qos=qos)
+                bh += 1
+                n += 1
+                if not qos:
+                    self._advance(rs, rp, bh)
+                else:
+                    sent.append((pid, rs, rp, bh))
+                    if len(sent) >= window and not self._settle(client, sent, acked, timeout_ms):
+                        return n - len(sent)
+            if sent and not self._settle(client, sent, acked, timeout_ms):
+                return n - len(sent)
+            return n
+        finally:
+            if qos:
+                client.cbstat = prev
+            if sent:
+                self._settle(None, sent, acked, 0)  # Keeps the messages acknowledged before an error
+            elif not qos:
+                self.stats['sent'] += n
+            if (seg, pos) != (self.rseg, self.rpos):
+                self._save_cursor()
+
+    def _settle(self, client, sent, acked, timeout_ms):
+        """
+        Private class method. Waits for the PUBACKs of the messages in sent and moves the read cursor past
+        those acknowledged in a row from the first one. They are removed from sent.
+
+        :param client: Client to wait on. None - don't wait.
+        :type client: MQTTClient
+        :return: True if every message was acknowledged
+        :rtype: bool
+        """
+        start = ticks_ms()
+        k = 0
+        while True:
+            while k < len(sent) and (sent[k][0] is None or sent[k][0] in acked):
+                k += 1
+            left = timeout_ms - ticks_diff(ticks_ms(), start)
+            if k == len(sent) or client is None or left <= 0:
+                break
+            client.wait(left)
+        if k:
+            self._advance(*sent[k - 1][1:])
+            self.stats['sent'] += k
+            del sent[:k]
+        acked.clear()
+        return not sent
@@ -1,7 +1,7 @@
 # rele_mqtt_botao_b.py - Controle de Relé com Botão B e MQTT na BitDogLab
 
 from machine import Pin
-from umqtt.simple import MQTTClient
+from umqtt.simple import MQTTClient, MQTTException, Topic, view_eq
 import network
 import time
 import json # Embora não estritamente necessário para comandos ON/OFF simples, pode ser útil para estados futuros
@@ -23,9 +23,10 @@ PIN_BUTTON_B = 5
 PIN_RELE = 20
 
 # Tópicos MQTT
-MQTT_TOPIC_RELE_STATE = "bitdoglab/rele/gpio20/state"    # Publica o estado atual (ON/OFF)
+MQTT_TOPIC_RELE_STATE = Topic("bitdoglab/rele/gpio20/state")    # Publica o estado atual (ON/OFF)
 MQTT_TOPIC_RELE_COMMAND = "bitdoglab/rele/gpio20/set"  # Recebe comandos (ON/OFF)
-MQTT_TOPIC_RELE_AVAILABILITY = "bitdoglab/rele/gpio20/status"
+MQTT_TOPIC_RELE_AVAILABILITY = Topic("bitdoglab/rele/gpio20/status")
+MQTT_TOPIC_RELE_COMMAND_B = MQTT_TOPIC_RELE_COMMAND.encode()  # Para comparar com o tópico recebido
 # --- Fim das Configurações do Usuário ---
 
 # Configuração dos Pinos
@@ -40,6 +41,7 @@ last_button_press_time = 0
 DEBOUNCE_MS = 250 # Aumentado um pouco para botões físicos
 
 mqtt_client = None
+inscrito = False  # A inscrição é feita uma vez; nas reconexões o cliente só a refaz se o broker perdeu a sessão
 
 def set_rele_state(novo_estado, origem="script"):
     global rele_estado_atual, mqtt_client
@@ -58,22 +60,21 @@ def toggle_rele_local():
     set_rele_state(novo_estado, origem="botao_local")
 
 def mqtt_callback(topic, msg, *args):
+    # topic e msg são memoryviews no buffer do cliente (set_callback com views=True):
+    # são comparados com constantes sem decodificar nem alocar
     global rele_estado_atual
-    print(f"Mensagem recebida - Tópico: {topic.decode()}, Mensagem: {msg.decode()}")
-    comando = msg.decode().upper()
-    
-    if topic.decode() == MQTT_TOPIC_RELE_COMMAND:
-        if comando == "ON" and rele_estado_atual == 0:
+    if view_eq(topic, MQTT_TOPIC_RELE_COMMAND_B):
+        if view_eq(msg, b"ON", True) and rele_estado_atual == 0:
             set_rele_state(1, origem="mqtt")
-        elif comando == "OFF" and rele_estado_atual == 1:
+        elif view_eq(msg, b"OFF", True) and rele_estado_atual == 1:
             set_rele_state(0, origem="mqtt")
-        elif comando == "TOGGLE":
+        elif view_eq(msg, b"TOGGLE", True):
              novo_estado = 1 - rele_estado_atual
              set_rele_state(novo_estado, origem="mqtt_toggle")
         else:
-            print(f"Comando MQTT inválido ou estado já é {comando}")
+            print(f"Comando MQTT inválido ou estado já é {bytes(msg).decode()}")
     else:
-        print(f"Mensagem recebida em tópico inesperado: {topic.decode()}")
+        print(f"Mensagem recebida em tópico inesperado: {bytes(topic).decode()}")
 
 def connect_wifi():
     wlan = network.WLAN(network.STA_IF)
@@ -96,14 +97,27 @@ def connect_wifi():
     return True
 
 def connect_and_subscribe_mqtt():
-    global mqtt_client
-    mqtt_client = MQTTClient(MQTT_CLIENT_ID, MQTT_BROKER, port=MQTT_PORT, user=MQTT_USER, password=MQTT_PASSWORD)
-    mqtt_client.set_callback(mqtt_callback)
+    global mqtt_client, inscrito
+    # O cliente é reaproveitado nas reconexões para não perder a fila offline
+    if mqtt_client is None:
+        mqtt_client = MQTTClient(MQTT_CLIENT_ID, MQTT_BROKER, port=MQTT_PORT, user=MQTT_USER, password=MQTT_PASSWORD)
+        mqtt_client.set_callback(mqtt_callback, views=True)
+        # Comandos QoS 1 reenviados pelo broker (PUBACK perdido) não são executados de novo
+        mqtt_client.set_dup_filter()
+        # Não republica estado retido igual ao último enviado (renova no máximo a cada 5 minutos)
+        mqtt_client.set_publish_cache(max_age=300)
+        # Estados publicados sem conexão ficam guardados (só o último, por serem retidos)
+        # e são enviados em ordem após a reconexão
+        mqtt_client.set_offline_buffer(slots=8)
     try:
-        mqtt_client.connect()
+        # Sessão persistente: o broker guarda a inscrição e reenvia, com DUP, os comandos QoS 1
+        # sem PUBACK, que o filtro de duplicados descarta se já tiverem sido executados
+        mqtt_client.resume()
         print(f"Conectado ao broker MQTT: {MQTT_BROKER}")
-        mqtt_client.subscribe(MQTT_TOPIC_RELE_COMMAND)
-        print(f"Inscrito no tópico de comando: {MQTT_TOPIC_RELE_COMMAND}")
+        if not inscrito:
+            mqtt_client.subscribe(MQTT_TOPIC_RELE_COMMAND, qos=1)
+            inscrito = True
+            print(f"Inscrito no tópico de comando: {MQTT_TOPIC_RELE_COMMAND}")
         # Publica disponibilidade e estado inicial
         mqtt_client.publish(MQTT_TOPIC_RELE_AVAILABILITY, b"online", retain=True)
         initial_state_str = "ON" if rele_estado_atual == 1 else "OFF"
@@ -138,18 +152,20 @@ else:
                         last_button_press_time = current_time
                         toggle_rele_local()
                         # Pequena pausa para o usuário soltar o botão antes da próxima checagem
-                        # e para evitar que o check_msg() seja chamado muitas vezes seguidas
+                        # e para evitar que o wait() seja chamado muitas vezes seguidas
                         # enquanto o botão está pressionado.
                         time.sleep_ms(DEBOUNCE_MS) 
                 
-                # Verifica mensagens MQTT
+                # Espera até 20 ms por mensagens MQTT, acordando assim que um comando chega
                 if mqtt_client:
-                    mqtt_client.check_msg()
-                
-                time.sleep_ms(20) # Pequena pausa no loop
+                    mqtt_client.wait(20)
+                else:
+                    time.sleep_ms(20) # Pequena pausa no loop
 
-            except OSError as e:
-                print(f"Erro de OSError no loop principal: {e}")
+            except (OSError, MQTTException) as e:
+                # Uma publicação que falha fecha o socket e vai para a fila offline; o wait() seguinte
+                # acusa a falta de conexão com MQTTException, que também precisa reconectar
+                print(f"Erro de comunicação MQTT no loop principal: {e}")
                 print("Tentando reconectar ao MQTT...")
                 time.sleep(5)
                 if mqtt_client: 
@@ -1,5 +1,7 @@
 from machine import Pin, SoftI2C
-from umqtt.simple import MQTTClient
+from umqtt.simple import MQTTClient, MQTTException, Topic
+from umqtt.scheduler import OutboundScheduler, CONTROL
+from umqtt.reconnect import Reconnector, CONNECTED
 import network
 import time
 import json
@@ -34,14 +36,14 @@ OLED_WIDTH = 128   # Largura do display
 OLED_HEIGHT = 64   # Altura do display
 
 # Tópicos MQTT - Relé A (GPIO 19)
-MQTT_TOPIC_RELE_A_STATE = "bitdoglab/rele/gpio19/state"
+MQTT_TOPIC_RELE_A_STATE = Topic("bitdoglab/rele/gpio19/state")  # Pré-codificado para publicações
 MQTT_TOPIC_RELE_A_COMMAND = "bitdoglab/rele/gpio19/set"
-MQTT_TOPIC_RELE_A_AVAILABILITY = "bitdoglab/rele/gpio19/status"
+MQTT_TOPIC_RELE_A_AVAILABILITY = Topic("bitdoglab/rele/gpio19/status")
 
 # Tópicos MQTT - Relé B (GPIO 20)
-MQTT_TOPIC_RELE_B_STATE = "bitdoglab/rele/gpio20/state"
+MQTT_TOPIC_RELE_B_STATE = Topic("bitdoglab/rele/gpio20/state")  # Pré-codificado para publicações
 MQTT_TOPIC_RELE_B_COMMAND = "bitdoglab/rele/gpio20/set"
-MQTT_TOPIC_RELE_B_AVAILABILITY = "bitdoglab/rele/gpio20/status"
+MQTT_TOPIC_RELE_B_AVAILABILITY = Topic("bitdoglab/rele/gpio20/status")
 
 # --- Fim das Configurações do Usuário ---
 
@@ -73,6 +75,9 @@ last_button_b_press_time = 0
 DEBOUNCE_MS = 250
 
 mqtt_client = None
+agendador = None  # Fila de publicação com prioridades e limite de taxa
+reconectador = None  # Reconexão do Wi-Fi e do broker com espera exponencial
+inscrito = False  # A inscrição é feita uma vez; nas reconexões o cliente só a refaz se o broker perdeu a sessão
 wifi_status = "Desconectado"
 mqtt_status = "Desconectado"
 last_display_update = 0
@@ -134,27 +139,27 @@ def update_display():
         print(f"Erro ao atualizar display: {e}")
 
 def set_rele_a_state(novo_estado, origem="script"):
-    global rele_a_estado_atual, mqtt_client
+    global rele_a_estado_atual, agendador
     rele_a_estado_atual = novo_estado
     rele_a.value(rele_a_estado_atual)
     estado_str = "ON" if rele_a_estado_atual == 1 else "OFF"
     print(f"Relé A (GPIO19) {estado_str} (Origem: {origem})")
-    if mqtt_client:
+    if agendador:
         try:
-            mqtt_client.publish(MQTT_TOPIC_RELE_A_STATE, estado_str.encode(), retain=True)
+            agendador.publish(MQTT_TOPIC_RELE_A_STATE, estado_str.encode(), retain=True, prio=CONTROL)
         except Exception as e:
             print(f"Erro ao publicar estado do relé A: {e}")
     update_display()  # Atualiza display quando o relé muda
 
 def set_rele_b_state(novo_estado, origem="script"):
-    global rele_b_estado_atual, mqtt_client
+    global rele_b_estado_atual, agendador
     rele_b_estado_atual = novo_estado
     rele_b.value(rele_b_estado_atual)
     estado_str = "ON" if rele_b_estado_atual == 1 else "OFF"
     print(f"Relé B (GPIO20) {estado_str} (Origem: {origem})")
-    if mqtt_client:
+    if agendador:
         try:
-            mqtt_client.publish(MQTT_TOPIC_RELE_B_STATE, estado_str.encode(), retain=True)
+            agendador.publish(MQTT_TOPIC_RELE_B_STATE, estado_str.encode(), retain=True, prio=CONTROL)
         except Exception as e:
             print(f"Erro ao publicar estado do relé B: {e}")
     update_display()  # Atualiza display quando o relé muda
@@ -167,157 +172,138 @@ def toggle_rele_b():
     novo_estado = 1 - rele_b_estado_atual
     set_rele_b_state(novo_estado, origem="botao_b")
 
-def mqtt_callback(topic, msg, *args):
-    global rele_a_estado_atual, rele_b_estado_atual
+def comando_rele_a(topic, msg, *args):
+    """Comandos recebidos em MQTT_TOPIC_RELE_A_COMMAND"""
     print(f"Mensagem recebida - Tópico: {topic.decode()}, Mensagem: {msg.decode()}")
     comando = msg.decode().upper()
-    topic_str = topic.decode()
-    
-    # Controle do Relé A (GPIO 19)
-    if topic_str == MQTT_TOPIC_RELE_A_COMMAND:
-        if comando == "ON" and rele_a_estado_atual == 0:
-            set_rele_a_state(1, origem="mqtt")
-        elif comando == "OFF" and rele_a_estado_atual == 1:
-            set_rele_a_state(0, origem="mqtt")
-        elif comando == "TOGGLE":
-            novo_estado = 1 - rele_a_estado_atual
-            set_rele_a_state(novo_estado, origem="mqtt_toggle")
-        else:
-            print(f"Comando MQTT inválido ou Relé A já está {comando}")
-    
-    # Controle do Relé B (GPIO 20)
-    elif topic_str == MQTT_TOPIC_RELE_B_COMMAND:
-        if comando == "ON" and rele_b_estado_atual == 0:
-            set_rele_b_state(1, origem="mqtt")
-        elif comando == "OFF" and rele_b_estado_atual == 1:
-            set_rele_b_state(0, origem="mqtt")
-        elif comando == "TOGGLE":
-            novo_estado = 1 - rele_b_estado_atual
-            set_rele_b_state(novo_estado, origem="mqtt_toggle")
-        else:
-            print(f"Comando MQTT inválido ou Relé B já está {comando}")
+    if comando == "ON" and rele_a_estado_atual == 0:
+        set_rele_a_state(1, origem="mqtt")
+    elif comando == "OFF" and rele_a_estado_atual == 1:
+        set_rele_a_state(0, origem="mqtt")
+    elif comando == "TOGGLE":
+        novo_estado = 1 - rele_a_estado_atual
+        set_rele_a_state(novo_estado, origem="mqtt_toggle")
     else:
-        print(f"Mensagem recebida em tópico inesperado: {topic_str}")
+        print(f"Comando MQTT inválido ou Relé A já está {comando}")
 
-def connect_wifi():
-    global wifi_status
-    wlan = network.WLAN(network.STA_IF)
-    wlan.active(True)
-    if not wlan.isconnected():
-        wifi_status = "Conectando..."
+def comando_rele_b(topic, msg, *args):
+    """Comandos recebidos em MQTT_TOPIC_RELE_B_COMMAND"""
+    print(f"Mensagem recebida - Tópico: {topic.decode()}, Mensagem: {msg.decode()}")
+    comando = msg.decode().upper()
+    if comando == "ON" and rele_b_estado_atual == 0:
+        set_rele_b_state(1, origem="mqtt")
+    elif comando == "OFF" and rele_b_estado_atual == 1:
+        set_rele_b_state(0, origem="mqtt")
+    elif comando == "TOGGLE":
+        novo_estado = 1 - rele_b_estado_atual
+        set_rele_b_state(novo_estado, origem="mqtt_toggle")
+    else:
+        print(f"Comando MQTT inválido ou Relé B já está {comando}")
+
+def mqtt_callback(topic, msg, *args):
+    """Mensagens em tópicos sem rota registrada"""
+    print(f"Mensagem recebida em tópico inesperado: {topic.decode()}")
+
+def restaurar_mqtt(client, present):
+    """Chamado pelo reconectador a cada conexão: publica disponibilidade e estados"""
+    global inscrito
+    print(f"Conectado ao broker MQTT: {MQTT_BROKER}")
+
+    # Inscreve nos tópicos de comando dos dois relés
+    if not inscrito:
+        client.subscribe(MQTT_TOPIC_RELE_A_COMMAND, qos=1)
+        client.subscribe(MQTT_TOPIC_RELE_B_COMMAND, qos=1)
+        inscrito = True
+        print(f"Inscrito nos tópicos: {MQTT_TOPIC_RELE_A_COMMAND} e {MQTT_TOPIC_RELE_B_COMMAND}")
+
+    # Publica disponibilidade e estados atuais num único envio
+    estado_a = "OFF" if rele_a_estado_atual == 0 else "ON"
+    estado_b = "OFF" if rele_b_estado_atual == 0 else "ON"
+    client.publish_many([
+        (MQTT_TOPIC_RELE_A_AVAILABILITY, b"online", True),
+        (MQTT_TOPIC_RELE_B_AVAILABILITY, b"online", True),
+        (MQTT_TOPIC_RELE_A_STATE, estado_a.encode(), True),
+        (MQTT_TOPIC_RELE_B_STATE, estado_b.encode(), True),
+    ])
+
+def atualizar_status():
+    """Reflete no display o estado do reconectador"""
+    global wifi_status, mqtt_status
+    wifi = "Conectado" if reconectador.wlan.isconnected() else "Desconectado"
+    mqtt = "Conectado" if reconectador.state == CONNECTED else "Reconectando"
+    if (wifi, mqtt) != (wifi_status, mqtt_status):
+        if mqtt == "Conectado" and reconectador.stats['reconnects']:
+            est = reconectador.stats
+            print(f"Reconectado em {est['last_ms']} ms (quedas do Wi-Fi: {est['wifi_drops']}, "
+                  f"do broker: {est['broker_drops']}, maior tempo: {est['max_ms']} ms)")
+        wifi_status, mqtt_status = wifi, mqtt
         update_display()
-        print(f"Conectando à rede {WIFI_SSID}...")
-        wlan.connect(WIFI_SSID, WIFI_PASSWORD)
-        timeout_wifi = 0
-        while not wlan.isconnected() and timeout_wifi < 20:
-            print(".", end="")
-            time.sleep(1)
-            timeout_wifi += 1
-        if wlan.isconnected():
-            wifi_status = "Conectado"
-            update_display()
-            print(f"\nConectado ao Wi-Fi! IP: {wlan.ifconfig()[0]}")
-            return True
-        else:
-            wifi_status = "Erro"
-            update_display()
-            print("\nFalha ao conectar ao Wi-Fi.")
-            return False
-    wifi_status = "Conectado"
-    update_display()
-    print(f"Já conectado ao Wi-Fi. IP: {wlan.ifconfig()[0]}")
-    return True
 
-def connect_and_subscribe_mqtt():
-    global mqtt_client, mqtt_status
+def iniciar_mqtt():
+    global mqtt_client, agendador, reconectador
     mqtt_client = MQTTClient(MQTT_CLIENT_ID, MQTT_BROKER, port=MQTT_PORT, user=MQTT_USER, password=MQTT_PASSWORD)
     mqtt_client.set_callback(mqtt_callback)
-    try:
-        mqtt_status = "Conectando..."
-        update_display()
-        mqtt_client.connect()
-        mqtt_status = "Conectado"
-        update_display()
-        print(f"Conectado ao broker MQTT: {MQTT_BROKER}")
-        
-        # Inscreve nos tópicos de comando dos dois relés
-        mqtt_client.subscribe(MQTT_TOPIC_RELE_A_COMMAND)
-        mqtt_client.subscribe(MQTT_TOPIC_RELE_B_COMMAND)
-        print(f"Inscrito nos tópicos: {MQTT_TOPIC_RELE_A_COMMAND} e {MQTT_TOPIC_RELE_B_COMMAND}")
-        
-        # Publica disponibilidade e estados iniciais
-        mqtt_client.publish(MQTT_TOPIC_RELE_A_AVAILABILITY, b"online", retain=True)
-        mqtt_client.publish(MQTT_TOPIC_RELE_B_AVAILABILITY, b"online", retain=True)
-        
-        initial_state_a = "OFF" if rele_a_estado_atual == 0 else "ON"
-        initial_state_b = "OFF" if rele_b_estado_atual == 0 else "ON"
-        mqtt_client.publish(MQTT_TOPIC_RELE_A_STATE, initial_state_a.encode(), retain=True)
-        mqtt_client.publish(MQTT_TOPIC_RELE_B_STATE, initial_state_b.encode(), retain=True)
-        
-        return True
-    except OSError as e:
-        mqtt_status = "Erro"
-        update_display()
-        print(f"Falha ao conectar ao broker MQTT: {e}")
-        return False
-    except Exception as e:
-        mqtt_status = "Erro"
-        update_display()
-        print(f"Outro erro MQTT: {e}")
-        return False
+    # Cada tópico de comando vai direto para o seu tratador, sem decodificar o tópico
+    mqtt_client.route(MQTT_TOPIC_RELE_A_COMMAND, comando_rele_a)
+    mqtt_client.route(MQTT_TOPIC_RELE_B_COMMAND, comando_rele_b)
+    # Os comandos não são agrupados com set_coalesce(): dois TOGGLE seguidos virariam um só
+    # e o relé ficaria no estado errado
+    # Comandos QoS 1 reenviados pelo broker (PUBACK perdido) não são executados de novo
+    mqtt_client.set_dup_filter()
+    # Não republica estado retido igual ao último enviado (renova no máximo a cada 5 minutos)
+    mqtt_client.set_publish_cache(max_age=300)
+    agendador = OutboundScheduler(mqtt_client)
+    # Quedas do Wi-Fi e do broker são tratadas em separado, com esperas de 1 s a 60 s sorteadas
+    # para que todos os dispositivos não reconectem juntos quando o broker reinicia
+    wlan = network.WLAN(network.STA_IF)
+    wlan.active(True)
+    # Sessão persistente (resume()): o broker guarda as inscrições e reenvia, com DUP, os comandos
+    # QoS 1 sem PUBACK, que o filtro de duplicados descarta se já tiverem sido executados
+    reconectador = Reconnector(mqtt_client, wlan, WIFI_SSID, WIFI_PASSWORD, session_expiry=3600)
+    reconectador.set_callback(restaurar_mqtt)
 
 print("Iniciando controle de 2 relés com Botões A, B e MQTT...")
 print(f"Botão A (GPIO{PIN_BUTTON_A}) -> Relé A (GPIO{PIN_RELE_A})")
 print(f"Botão B (GPIO{PIN_BUTTON_B}) -> Relé B (GPIO{PIN_RELE_B})")
 
-if not connect_wifi():
-    print("Não foi possível conectar ao Wi-Fi. Verifique as configurações e reinicie.")
-else:
-    if not connect_and_subscribe_mqtt():
-        print("Não foi possível conectar ao MQTT. Verifique as configurações e reinicie.")
-    else:
-        print("Sistema pronto. Pressione os Botões A/B ou envie comandos MQTT.")
+iniciar_mqtt()
+print("Sistema pronto. Pressione os Botões A/B ou envie comandos MQTT.")
 
-        while True:
-            try:
-                # Verifica botão A (controla Relé A - GPIO 19)
-                if button_a.value() == 0:
-                    current_time = time.ticks_ms()
-                    if time.ticks_diff(current_time, last_button_a_press_time) > DEBOUNCE_MS:
-                        last_button_a_press_time = current_time
-                        toggle_rele_a()
-                        time.sleep_ms(DEBOUNCE_MS)
-                
-                # Verifica botão B (controla Relé B - GPIO 20)
-                if button_b.value() == 0:
-                    current_time = time.ticks_ms()
-                    if time.ticks_diff(current_time, last_button_b_press_time) > DEBOUNCE_MS:
-                        last_button_b_press_time = current_time
-                        toggle_rele_b()
-                        time.sleep_ms(DEBOUNCE_MS)
-                
-                # Verifica mensagens MQTT
-                if mqtt_client:
-                    mqtt_client.check_msg()
-                
-                # Atualiza display periodicamente
-                update_display()
-                
-                time.sleep_ms(20)
+while True:
+    try:
+        # Verifica botão A (controla Relé A - GPIO 19)
+        if button_a.value() == 0:
+            current_time = time.ticks_ms()
+            if time.ticks_diff(current_time, last_button_a_press_time) > DEBOUNCE_MS:
+                last_button_a_press_time = current_time
+                toggle_rele_a()
+                time.sleep_ms(DEBOUNCE_MS)
+        
+        # Verifica botão B (controla Relé B - GPIO 20)
+        if button_b.value() == 0:
+            current_time = time.ticks_ms()
+            if time.ticks_diff(current_time, last_button_b_press_time) > DEBOUNCE_MS:
+                last_button_b_press_time = current_time
+                toggle_rele_b()
+                time.sleep_ms(DEBOUNCE_MS)
+        
+        # Espera até 20 ms por mensagens MQTT, acordando assim que um comando chega;
+        # sem conexão, os botões continuam funcionando enquanto o reconectador aguarda a próxima tentativa
+        if reconectador.step():
+            mqtt_client.wait(20)
+            agendador.service()  # Envia publicações retidas pelo limite de taxa
+        else:
+            time.sleep_ms(20)
+        atualizar_status()
+        
+        # Atualiza display periodicamente
+        update_display()
 
-            except OSError as e:
-                print(f"Erro de OSError no loop principal: {e}")
-                print("Tentando reconectar ao MQTT...")
-                time.sleep(5)
-                if mqtt_client: 
-                    try:
-                        mqtt_client.disconnect()
-                    except: pass
-                if not connect_and_subscribe_mqtt():
-                    print("Falha ao reconectar ao MQTT. Reiniciando em 30s...")
-                    time.sleep(30)
-                else:
-                    print("Reconectado ao MQTT com sucesso.")
-            except Exception as e:
-                print(f"Erro inesperado no loop principal: {e}")
-                time.sleep(10)
\ No newline at end of file
+    except (OSError, MQTTException) as e:
+        print(f"Erro de comunicação MQTT no loop principal: {e}")
+        print("Tentando reconectar...")
+        reconectador.failed()
+        atualizar_status()
+    except Exception as e:
+        print(f"Erro inesperado no loop principal: {e}")
+        time.sleep(10)
\ No newline at end of file
@@ -1,22 +1,344 @@
 import usocket as socket
 import uselect
-from utime import ticks_add, ticks_ms, ticks_diff
+from utime import ticks_add, ticks_ms, ticks_us, ticks_diff
 
 
 class MQTTException(Exception):
     pass
 
 
+def _write_failed(e):
+    # MQTTException 6 and 7, windows full, are raised before anything is written
+    return not (isinstance(e, MQTTException) and e.args and e.args[0] in (6, 7))
+
+
+def _bytes(s):
+    # MicroPython sockets accept str, but packets are assembled in a bytearray.
+    return s.encode() if isinstance(s, str) else s
+
+
+def _deflate(data):
+    # deflate module: MicroPython >= 1.21 (compression must be enabled in the port), zlib: CPython.
+    try:
+        import deflate
+        import io
+    except ImportError:
+        import zlib
+        return zlib.compress(data)
+    out = io.BytesIO()
+    d = deflate.DeflateIO(out, deflate.ZLIB)
+    d.write(data)
+    d.close()
+    return out.getvalue()
+
+
+def _inflate(data):
+    try:
+        import deflate
+        import io
+    except ImportError:
+        import zlib
+        return zlib.decompress(data)
+    return deflate.DeflateIO(io.BytesIO(data), deflate.ZLIB).read()
+
+
+def _varlen_decode(buf, i):
+    # Returns the Variable Byte Integer at buf[i] and the position after it.
+    n = 0
+    sh = 0
+    while 1:
+        b = buf[i]
+        i += 1
+        n |= (b & 0x7f) << sh
+        if not b & 0x80:
+            return n, i
+        sh += 7
+
+
+def _varlen_size(n):
+    return 1 if n < 0x80 else 2 if n < 0x4000 else 3 if n < 0x200000 else 4
+
+
+# MQTT 5 property identifiers grouped by value type (2.2.2.2 Property).
+# The remaining ones are UTF-8 strings or binary data, except 0x26 (User Property), a string pair.
+_PROP_BYTE = (0x01, 0x17, 0x19, 0x24, 0x25, 0x28, 0x29, 0x2A)
+_PROP_INT2 = (0x13, 0x21, 0x22, 0x23)
+_PROP_INT4 = (0x02, 0x11, 0x18, 0x27)
+
+
+def _parse_props(buf, i):
+    # Returns the MQTT 5 properties at buf[i] as {identifier: value} and the position after them.
+    n, i = _varlen_decode(buf, i)
+    end = i + n
+    props = {}
+    while i < end:
+        p = buf[i]
+        i += 1
+        if p in _PROP_BYTE:
+            v = buf[i]
+            i += 1
+        elif p in _PROP_INT2:
+            v = buf[i] << 8 | buf[i + 1]
+            i += 2
+        elif p in _PROP_INT4:
+            v = int.from_bytes(bytes(buf[i:i + 4]), 'big')
+            i += 4
+        elif p == 0x0B:  # Subscription Identifier, Variable Byte Integer
+            v, i = _varlen_decode(buf, i)
+        else:
+            ln = buf[i] << 8 | buf[i + 1]
+            v = bytes(buf[i + 2:i + 2 + ln])
+            i += 2 + ln
+            if p == 0x26:
+                ln = buf[i] << 8 | buf[i + 1]
+                v = (v, bytes(buf[i + 2:i + 2 + ln]))
+                i += 2 + ln
+        props[p] = v
+    return props, end
+
+
+def view_eq(view, const, ignore_case=False):
+    """
+    Compares a received topic or payload with a constant, without allocating.
+
+    :param view: Topic or payload, e.g. a memoryview passed to a callback in views mode
+    :type view: memoryview or bytes
+    :param const: Constant to compare with
+    :type const: bytes
+    :param ignore_case: Compare ASCII letters case-insensitively. const must then be in upper case.
+    :type ignore_case: bool
+    :return: True if equal
+    :rtype: bool
+    """
+    n = len(const)
+    if len(view) != n:
+        return False
+    for i in range(n):
+        c = view[i]
+        if ignore_case and 0x61 <= c <= 0x7a:
+            c -= 0x20
+        if c != const[i]:
+            return False
+    return True
+
+
+class Topic:
+    """
+    Pre-encoded topic name.
+
+    Keeps the UTF-8 bytes of the topic behind their 2-byte length prefix, so PUBLISH and SUBSCRIBE
+    packets copy it as is. Create one with MQTTClient.topic(), or directly for module level constants.
+    """
+
+    def __init__(self, name):
+        """
+        :param name: Topic name. Takes the form "path/to/topic"
+        :type name: str
+        """
+        name = _bytes(name)
+        assert len(name) < 65536
+        self.name = name
+        self.data = len(name).to_bytes(2, 'big') + name
+
+    def __len__(self):
+        return len(self.name)
+
+
+# Trie keys besides topic bytes
+_PLUS = -1  # Child matched by a '+' level
+_HASH = -2  # Values of a '#' level
+_END = -3  # Values of filters ending at this node
+
+
+class Router:
+    """
+    Topic filters with '+' and '#' wildcards, compiled into a trie with one node per topic byte.
+
+    Matching walks the raw topic bytes, so a bytes object or a memoryview into the receive buffer
+    is matched without being decoded or sliced.
+    """
+
+    def __init__(self):
+        self.root = {}
+
+    def add(self, topic_filter, value):
+        """
+        :param topic_filter: Topic filter. Takes the form "path/+/topic" or "path/#"
+        :type topic_filter: str
+        :param value: Value returned for topics matching topic_filter
+        """
+        node = self.root
+        levels = _bytes(topic_filter).split(b'/')
+        for k, level in enumerate(levels):
+            if k:
+                node = node.setdefault(0x2f, {})  # '/'
+            if level == b'#':
+                assert k == len(levels) - 1, "'#' must be the last level"
+                node.setdefault(_HASH, []).append(value)
+                return
+            if level == b'+':
+                node = node.setdefault(_PLUS, {})
+            else:
+                for c in level:
+                    node = node.setdefault(c, {})
+        node.setdefault(_END, []).append(value)
+
+    def match(self, topic, out):
+        """
+        :param topic: Topic name
+        :type topic: bytes or memoryview
+        :param out: List the values of all matching filters are appended to
+        :type out: list
+        :return: out
+        """
+        self._match(self.root, topic, 0, out)
+        return out
+
+    def _match(self, node, topic, i, out):
+        # i is at the start of a level
+        n = len(topic)
+        if i or not n or topic[0] != 0x24:  # Wildcards don't match a first level starting with '$'
+            v = node.get(_HASH)
+            if v:
+                out.extend(v)
+            p = node.get(_PLUS)
+            if p is not None:
+                j = i
+                while j < n and topic[j] != 0x2f:
+                    j += 1
+                self._level_end(p, topic, j, out)
+        while i < n and topic[i] != 0x2f:
+            node = node.get(topic[i])
+            if node is None:
+                return
+            i += 1
+        self._level_end(node, topic, i, out)
+
+    def _level_end(self, node, topic, i, out):
+        # i is at the '/' ending a level, or at the end of the topic
+        if i == len(topic):
+            v = node.get(_END)
+            if v:
+                out.extend(v)
+            node = node.get(0x2f)
+            if node:  # "path/#" also matches "path"
+                v = node.get(_HASH)
+                if v:
+                    out.extend(v)
+        else:
+            node = node.get(0x2f)
+            if node is not None:
+                self._match(node, topic, i + 1, out)
+
+
+def _heap_push(heap, item):
+    # Binary min-heap of (ticks, value) ordered with ticks_diff, so it stays correct when ticks wrap around.
+    heap.append(item)
+    i = len(heap) - 1
+    while i:
+        p = (i - 1) >> 1
+        if ticks_diff(item[0], heap[p][0]) >= 0:
+            break
+        heap[i] = heap[p]
+        i = p
+    heap[i] = item
+
+
+def _heap_pop(heap):
+    top = heap[0]
+    item = heap.pop()
+    n = len(heap)
+    if n:
+        i = 0
+        while True:
+            c = 2 * i + 1
+            if c >= n:
+                break
+            if c + 1 < n and ticks_diff(heap[c + 1][0], heap[c][0]) < 0:
+                c += 1
+            if ticks_diff(heap[c][0], item[0]) >= 0:
+                break
+            heap[i] = heap[c]
+            i = c
+        heap[i] = item
+    return top
+
+
 def pid_gen(pid=0):
     while True:
         pid = pid + 1 if pid < 65535 else 1
         yield pid
 
 
+class PidAllocator:
+    """
+    Packet identifiers that are never handed out again while still awaiting their ACK.
+
+    Identifiers are allocated in increasing order like pid_gen. Identifier p takes bit p % window of a bitmap
+    until freed, and identifiers whose bit is taken are skipped, so alloc() and free() don't depend on how many
+    messages are in flight.
+    """
+
+    def __init__(self, window=256):
+        """
+        :param window: Number of bits, a power of two. At most window identifiers can be in flight.
+        :type window: int
+        """
+        assert window >= 8 and not window & (window - 1)
+        self.bits = bytearray(window >> 3)
+        self.mask = window - 1
+        self.pid = 0
+        self.used = 0
+
+    def alloc(self):
+        """
+        :return: Packet identifier, 1 to 65535
+        :rtype: int
+        """
+        if self.used > self.mask:
+            raise MQTTException(7)  # Every identifier of the window is in flight
+        bits = self.bits
+        pid = self.pid
+        while True:
+            pid = pid + 1 if pid < 65535 else 1
+            b = pid & self.mask
+            if not bits[b >> 3] & 1 << (b & 7):
+                bits[b >> 3] |= 1 << (b & 7)
+                self.pid = pid
+                self.used += 1
+                return pid
+
+    def free(self, pid):
+        """
+        :param pid: Packet identifier returned by alloc()
+        :type pid: int
+        """
+        b = pid & self.mask
+        m = 1 << (b & 7)
+        if self.bits[b >> 3] & m:
+            self.bits[b >> 3] &= ~m
+            self.used -= 1
+
+    def reset(self, keep=()):
+        """
+        Frees every identifier, including any lost track of by an interrupted send.
+
+        :param keep: Identifiers to leave allocated
+        """
+        self.bits[:] = bytes(len(self.bits))
+        self.used = 0
+        for pid in keep:
+            b = pid & self.mask
+            if not self.bits[b >> 3] & 1 << (b & 7):
+                self.bits[b >> 3] |= 1 << (b & 7)
+                self.used += 1
+
+
 class MQTTClient:
 
     def __init__(self, client_id, server, port=0, user=None, password=None, keepalive=0,
-                 ssl=False, ssl_params=None, socket_timeout=5, message_timeout=10):
+                 ssl=False, ssl_params=None, socket_timeout=5, message_timeout=10, buffer_size=256, protocol=4,
+                 rx_buffer_size=512):
         """
         Default constructor, initializes MQTTClient object.
 
@@ -46,7 +368,19 @@ class MQTTClient:
         :param message_timeout: The time in seconds after which the library recognizes that a message with QoS=1
                                 or topic subscription has not been received by the server.
         :type message_timeout: int
+        :param buffer_size: Size in bytes of the preallocated buffer in which outgoing packets are assembled.
+                            Each packet that fits is sent with a single socket write. It also bounds how many
+                            packets are batched between cork() and flush().
+        :type buffer_size: int
+        :param rx_buffer_size: Size in bytes of the preallocated buffer into which incoming packets are read.
+                               Packets that don't fit are read into a buffer of their own.
+        :type rx_buffer_size: int
+        :param protocol: MQTT protocol level: 4 for MQTT 3.1.1, 5 for MQTT 5.0. In MQTT 5 mode repeated
+                         publishes to the same topic send a 2-byte topic alias instead of the topic name,
+                         within the Topic Alias Maximum announced by the server.
+        :type protocol: int
         """
+        assert protocol in (4, 5)
         if port == 0:
             port = 8883 if ssl else 1883
         self.client_id = client_id
@@ -57,9 +391,12 @@ class MQTTClient:
         self.port = port
         self.ssl = ssl
         self.ssl_params = ssl_params if ssl_params else {}
-        self.newpid = pid_gen()
+        self.pids = PidAllocator()
         if not getattr(self, 'cb', None):
             self.cb = None
+        self.cb_views = False
+        self.cb_stream = None
+        self.stream_threshold = 0
         if not getattr(self, 'cbstat', None):
             self.cbstat = lambda p, s: None
         self.user = user
@@ -70,48 +407,345 @@ class MQTTClient:
         self.lw_qos = 0
         self.lw_retain = False
         self.rcv_pids = {}  # PUBACK and SUBACK pids awaiting ACK response
+        self._subs = {}  # Topic filter -> QoS of every subscribe(), sent again by resume()
+        self.session_expiry = 0  # MQTT 5 Session Expiry Interval in seconds, see resume()
+        self._deadlines = []  # (deadline, pid) heap of rcv_pids, see _message_timeout()
+        self._topics = {}  # Topic handles created by topic()
+        self._router = None  # Handlers registered with route()
+        self._matched = []  # Reused by every dispatch
+        self._coalesce = None  # Topic filters set by set_coalesce()
+        self._rx_pids = None  # Pids of the last QoS 1 messages received, see set_dup_filter()
+        self._ob = None  # Ring of messages published while disconnected, see set_offline_buffer()
+        self._held = []  # [topic, msg, retained, dup] of coalesced messages not delivered yet
+        self._registered = None  # Socket passed to the last register(), see unregister()
+        self.protocol = protocol
+        self.connack_props = {}  # MQTT 5 properties of the last CONNACK
+        self.topic_alias_max = 0
+        self._aliases = {}  # Outbound topic -> alias
+        self.z_threshold = None  # Compression is off until set_compression() is called
+        self.z_marker = None
+        self.z_suffix = None
+        self._lv = None  # Last-value cache, see set_publish_cache()
+        self.lv_max_age = None
+        self.lv_max_payload = 0
+        self._slab = None  # Unacknowledged QoS 1 PUBLISH frames, see set_retransmit()
+        self._inflight = {}  # pid -> slot of every QoS 1 PUBLISH awaiting PUBACK while the slab is set
+        self.max_retries = 0
+        self._pub_kept = False  # The last _publish() left a copy of its packet in the slab
 
         self.last_ping = ticks_ms()  # Time of the last PING sent
         self.last_cpacket = ticks_ms()  # Time of last Control Packet
+        self._last_tx = ticks_ms()  # Time of the last write to the socket, see _keepalive()
+        self._ping_sent = None  # Time of the PINGREQ awaiting its PINGRESP
+        self.ping_rtt = None  # Milliseconds between the last answered PINGREQ and its PINGRESP
+        self.ping_fraction = 0.5  # See set_auto_ping()
+        self.ping_timeout = None
 
         self.socket_timeout = socket_timeout
         self.message_timeout = message_timeout
 
-    def _read(self, n):
+        self._wbuf = bytearray(buffer_size)  # Outgoing packets are assembled here
+        self._wmv = memoryview(self._wbuf)
+        self._wlen = 0  # Bytes in _wbuf waiting to be sent
+        self._corked = False
+        self._rbuf = bytearray(rx_buffer_size)  # Incoming bytes, unparsed from _rhead to _rtail
+        self._rmv = memoryview(self._rbuf)
+        self._rhead = 0
+        self._rtail = 0
+        self._big = None  # [first byte, body, bytes received] of a packet larger than _rbuf
+        self._stream = None  # [first byte, topic, pid, payload bytes delivered, payload size] of a streamed PUBLISH
+        # tx_writes / tx_packets and tx_polls / tx_packets give the socket cost of each sent packet,
+        # rx_reads / rx_packets that of each received one.
+        self.stats = {'tx_packets': 0, 'tx_writes': 0, 'tx_polls': 0,
+                      'rx_packets': 0, 'rx_reads': 0, 'rx_polls': 0, 'pings': 0, 'dead_links': 0}
+
+    def _fill(self):
         """
-        Private class method.
+        Private class method. Reads whatever the socket has available into the receive buffer, without blocking.
 
-        :param n: Expected length of read bytes
-        :type n: int
-        :return:
+        :return: Number of bytes read, 0 if nothing was available or the buffer is full.
+        :rtype: int
 
         Notes:
-        Current usocket implementation returns None on .read from
+        Current usocket implementation returns None on .readinto from
         non-blocking socket with no data. However, OSError
         EAGAIN is checked for in case this ever changes.
         """
-        if n < 0:
-            raise MQTTException(2)
-        msg = b''
-        while len(msg) < n:
+        if self._rhead == self._rtail:
+            self._rhead = self._rtail = 0
+        elif self._rtail == len(self._rbuf) and self._rhead:
+            # Move the unparsed bytes to the front to make room behind them,
+            # in pieces that don't overlap their destination.
+            h = self._rhead
+            n = self._rtail - h
+            i = 0
+            while i < n:
+                k = min(h, n - i)
+                self._rbuf[i:i + k] = self._rmv[h + i:h + i + k]
+                i += k
+            self._rhead = 0
+            self._rtail = n
+        if self._rtail == len(self._rbuf):
+            return 0
+        try:
+            n = self.sock.readinto(self._rmv[self._rtail:])
+        except OSError as e:
+            if e.args[0] == 11 or e.args[0] == 110:  # EAGAIN / EWOULDBLOCK, ETIMEDOUT
+                n = None
+            else:
+                raise
+        except AttributeError:
+            raise MQTTException(8)
+        self.stats['rx_reads'] += 1
+        if n is None:
+            return 0
+        if n == 0:
+            raise MQTTException(1)  # Connection closed by host
+        self._rtail += n
+        return n
+
+    def _read_into(self, mv):
+        """
+        Private class method. Fills mv from the receive buffer and then straight from the socket, blocking
+        up to socket_timeout for each missing chunk.
+
+        :param mv: Destination
+        :type mv: memoryview
+        :return: None
+        """
+        n = min(len(mv), self._rtail - self._rhead)
+        mv[:n] = self._rmv[self._rhead:self._rhead + n]
+        self._rhead += n
+        while n < len(mv):
             try:
-                rbytes = self.sock.read(n - len(msg))
+                r = self.sock.readinto(mv[n:])
             except OSError as e:
-                if e.args[0] == 11:     # EAGAIN / EWOULDBLOCK
-                    rbytes = None
+                if e.args[0] == 11:  # EAGAIN / EWOULDBLOCK
+                    r = None
                 else:
                     raise
             except AttributeError:
                 raise MQTTException(8)
-            if rbytes is None:
+            self.stats['rx_reads'] += 1
+            if r is None:
                 self._sock_timeout(self.poller_r, self.socket_timeout)
-                continue
-            if rbytes == b'':
-                raise MQTTException(1) # Connection closed by host (?)
+            elif r == 0:
+                raise MQTTException(1)  # Connection closed by host
             else:
-                msg += rbytes
+                n += r
+
+    def _read(self, n):
+        """
+        Private class method.
+
+        :param n: Expected length of read bytes
+        :type n: int
+        :return: The bytes, waiting up to socket_timeout for each missing chunk.
+        """
+        if n < 0:
+            raise MQTTException(2)
+        if n > len(self._rbuf):
+            msg = bytearray(n)
+            self._read_into(memoryview(msg))
+            return msg
+        while self._rtail - self._rhead < n:
+            if not self._fill():
+                self._sock_timeout(self.poller_r, self.socket_timeout)
+        msg = bytes(self._rmv[self._rhead:self._rhead + n])
+        self._rhead += n
         return msg
 
+    def _take_into(self, mv):
+        """
+        Private class method. Fills mv from the receive buffer and, if that is not enough,
+        with one non-blocking read from the socket.
+
+        :param mv: Destination
+        :type mv: memoryview
+        :return: Number of bytes stored in mv
+        :rtype: int
+        """
+        n = min(len(mv), self._rtail - self._rhead)
+        mv[:n] = self._rmv[self._rhead:self._rhead + n]
+        self._rhead += n
+        if n == len(mv):
+            return n
+        try:
+            r = self.sock.readinto(mv[n:])
+        except OSError as e:
+            if e.args[0] == 11 or e.args[0] == 110:  # EAGAIN / EWOULDBLOCK, ETIMEDOUT
+                r = None
+            else:
+                raise
+        except AttributeError:
+            raise MQTTException(8)
+        self.stats['rx_reads'] += 1
+        if r == 0:
+            raise MQTTException(1)  # Connection closed by host
+        return n + (r or 0)
+
+    def _next_packet(self, block):
+        """
+        Private class method. Takes the next complete packet out of the receive buffer.
+
+        A partially received packet is kept between calls: the buffer holds it if it fits, else _big does,
+        so the parser resumes where it stopped when more data arrives.
+
+        :param block: Wait up to socket_timeout per chunk until a complete packet is received.
+        :type block: bool
+        :return: (first byte, body) or None if no complete packet is available. The body is a memoryview
+                 into the receive buffer, valid until the next read from the socket.
+        :rtype: tuple
+        """
+        buf = self._rbuf
+        while True:
+            if self._stream:
+                op = self._stream[0]
+                if self._stream_step():
+                    self.stats['rx_packets'] += 1
+                    return op, None
+                if self._fill():
+                    continue
+            elif self._big:
+                # Packet larger than the receive buffer, read into a buffer of its own
+                op, body, n = self._big
+                k = self._take_into(memoryview(body)[n:])
+                n += k
+                if n == len(body):
+                    self._big = None
+                    self.stats['rx_packets'] += 1
+                    return op, memoryview(body)
+                self._big[2] = n
+                if k:
+                    continue
+            else:
+                h = self._rhead
+                avail = self._rtail - h
+                # Fixed header: packet type and flags, then Remaining Length in 1 to 4 bytes
+                i = 1
+                sz = 0
+                sh = 0
+                while i < avail:
+                    b = buf[h + i]
+                    sz |= (b & 0x7f) << sh
+                    i += 1
+                    if not b & 0x80:
+                        break
+                    sh += 7
+                else:
+                    i = 0  # Remaining Length not complete yet
+                if i:
+                    op = buf[h]
+                    stream = self.cb_stream and op & 0xf0 == 0x30 and sz > self.stream_threshold
+                    if stream and self._stream_start(op, h + i, sz):
+                        continue
+                    if i + sz <= avail and not stream:
+                        self._rhead = h + i + sz
+                        self.stats['rx_packets'] += 1
+                        return op, self._rmv[h + i:h + i + sz]
+                    # A streamed PUBLISH only falls back to a buffer of its own if its
+                    # variable header doesn't fit in the receive buffer.
+                    if i + sz > len(buf) and not (stream and (h or self._rtail < len(buf))):
+                        self._rhead = h + i
+                        self._big = [op, bytearray(sz), 0]
+                        continue
+                if self._fill():
+                    continue
+            if not block:
+                return None
+            self._sock_timeout(self.poller_r, self.socket_timeout)
+
+    def _stream_start(self, op, p, sz):
+        """
+        Private class method. Starts streaming a PUBLISH once its variable header is in the receive buffer.
+
+        :param op: First byte of the fixed header
+        :type op: int
+        :param p: Offset of the variable header in the receive buffer
+        :type p: int
+        :param sz: Remaining Length of the packet
+        :type sz: int
+        :return: False if the variable header is not complete yet.
+        :rtype: bool
+        """
+        if op & 6 == 4:  # QoS==2
+            raise NotImplementedError()
+        if op & 6 == 6:  # 3.3.1.2 QoS - Reserved – must not be used
+            raise MQTTException(-1)
+        buf = self._rbuf
+        t = self._rtail
+        if p + 2 > t:
+            return False
+        j = p + 2 + (buf[p] << 8 | buf[p + 1])
+        if j + (2 if op & 6 else 0) > t:
+            return False
+        topic = self._rmv[p + 2:j]
+        pid = 0
+        if op & 6:
+            pid = buf[j] << 8 | buf[j + 1]
+            j += 2
+        if self.protocol == 5:  # Properties are skipped
+            n = 0
+            sh = 0
+            while True:
+                if j >= t:
+                    return False
+                b = buf[j]
+                j += 1
+                n |= (b & 0x7f) << sh
+                if not b & 0x80:
+                    break
+                sh += 7
+            j += n
+            if j > t:
+                return False
+        if op & 6 and self._rx_pids and self._seen(pid, op & 0x08):
+            topic = None  # Redelivered, the payload is skipped
+        else:
+            topic = bytes(topic)
+        self._rhead = j
+        self._stream = [op, topic, pid, 0, sz - (j - p)]
+        return True
+
+    def _stream_step(self):
+        """
+        Private class method. Passes the buffered part of a streamed PUBLISH payload to the stream callback.
+
+        :return: True once the whole payload has been delivered.
+        :rtype: bool
+        """
+        st = self._stream
+        op, topic, pid, off, total = st
+        h = self._rhead
+        n = min(self._rtail - h, total - off)
+        if n:
+            self._rhead = h + n
+            st[3] = off + n
+            if topic is not None:
+                self.cb_stream(topic, self._rmv[h:h + n], off, total)
+            off += n
+        if off < total:
+            return False
+        self._stream = None
+        self.last_cpacket = ticks_ms()
+        if op & 6 == 2:  # QoS==1, acknowledged once the whole payload was delivered
+            self._puback(pid)
+        return True
+
+    def _puback(self, pid):
+        """
+        Private class method. Sends a PUBACK for a received QoS 1 PUBLISH.
+
+        :param pid: Packet identifier of the PUBLISH
+        :type pid: int
+        """
+        buf, i = self._begin(4)
+        buf[i] = 0x40
+        buf[i + 1] = 0x02
+        buf[i + 2] = pid >> 8
+        buf[i + 3] = pid & 0xFF
+        self._commit(buf, i + 4)
+
     def _write(self, bytes_wr, length=-1):
         """
         Private class method.
@@ -123,11 +757,13 @@ class MQTTClient:
         :return:
         """
         # In non-blocking socket mode, the entire block of data may not be sent.
+        self.stats['tx_writes'] += 1
         try:
             self._sock_timeout(self.poller_w, self.socket_timeout)
             out = self.sock.write(bytes_wr, length)
         except AttributeError:
             raise MQTTException(8)
+        self._last_tx = ticks_ms()
         if length < 0:
             if out != len(bytes_wr):
                 raise MQTTException(3)
@@ -136,16 +772,88 @@ class MQTTClient:
                 raise MQTTException(3)
         return out
 
-    def _send_str(self, s):
+    def _begin(self, n):
         """
-        Private class method.
-        :param s:
-        :type s: byte
+        Private class method. Reserves room for a packet of up to n bytes.
+
+        Pending packets are flushed first if the packet does not fit behind them.
+
+        :param n: Maximum size of the packet
+        :type n: int
+        :return: Buffer and offset at which the packet must be assembled. The buffer is the preallocated
+                 write buffer, or a one-off buffer if the packet is larger than it.
+        :rtype: tuple
+        """
+        if self._wlen + n > len(self._wbuf):
+            self._flush()
+            if n > len(self._wbuf):
+                return bytearray(n), 0
+        return self._wbuf, self._wlen
+
+    def _commit(self, buf, end):
+        """
+        Private class method. Queues the packet assembled by _begin() and sends it unless corked.
+
+        :param buf: Buffer returned by _begin()
+        :type buf: bytearray
+        :param end: Offset in buf after the last byte of the packet
+        :type end: int
+        :return: None
+        """
+        self.stats['tx_packets'] += 1
+        if buf is self._wbuf:
+            self._wlen = end
+            if not self._corked:
+                self._flush()
+        else:
+            self._write(buf, end)
+
+    def _flush(self):
+        """
+        Private class method. Sends all pending packets with a single write.
+
+        :return: None
+        """
+        if self._wlen:
+            n = self._wlen
+            self._wlen = 0
+            self._write(self._wbuf, n)
+
+    def _send_const(self, pkt):
+        """
+        Private class method. Sends a fixed packet such as PINGREQ or DISCONNECT.
+
+        :param pkt: Complete packet
+        :type pkt: bytes
         :return: None
         """
-        assert len(s) < 65536
-        self._write(len(s).to_bytes(2, 'big'))
-        self._write(s)
+        buf, i = self._begin(len(pkt))
+        buf[i:i + len(pkt)] = pkt
+        self._commit(buf, i + len(pkt))
+
+    def _put_str(self, buf, offset, s):
+        """
+        Private class method. Copies a string with its 2-byte length prefix into buf.
+
+        :param buf: Packet buffer
+        :type buf: bytearray
+        :param offset: Position in buf
+        :type offset: int
+        :param s: String to copy
+        :type s: byte or Topic
+        :return: Position in buf after the string
+        :rtype: int
+        """
+        if isinstance(s, Topic):
+            n = len(s.data)
+            buf[offset:offset + n] = s.data
+            return offset + n
+        n = len(s)
+        assert n < 65536
+        buf[offset] = n >> 8
+        buf[offset + 1] = n & 0xFF
+        buf[offset + 2:offset + 2 + n] = s
+        return offset + 2 + n
 
     def _recv_len(self):
         """
@@ -173,6 +881,7 @@ class MQTTClient:
 
     def _sock_timeout(self, poller, socket_timeout):
         if self.sock:
+            self.stats['tx_polls' if poller == self.poller_w else 'rx_polls'] += 1
             res = poller.poll(-1 if socket_timeout is None else int(socket_timeout * 1000))
             # https://github.com/micropython/micropython/issues/3747#issuecomment-385650294
             # Sockets on esp8266 don't return POLLHUP or POLLERR at all.
@@ -192,13 +901,51 @@ class MQTTClient:
         else:
             raise MQTTException(28)
 
-    def set_callback(self, f):
+    def topic(self, name):
+        """
+        Returns the cached pre-encoded handle of a topic.
+
+        Passing the handle instead of a str to publish() or subscribe() saves the encoding and
+        length computation of the topic on every call.
+
+        :param name: Topic name. Takes the form "path/to/topic"
+        :type name: str
+        :return: Topic handle
+        :rtype: Topic
+        """
+        t = self._topics.get(name)
+        if t is None:
+            t = self._topics[name] = Topic(name)
+        return t
+
+    def set_callback(self, f, views=False):
         """
         Set callback for received subscription messages.
 
         :param f: callable(topic, msg, retained, duplicate)
+        :param views: Pass topic and msg to the callback and to route() handlers as memoryviews into the receive
+                      buffer instead of bytes copies. They are only valid during the call and must not be modified
+                      or kept; compare them with view_eq() or copy them with bytes().
+        :type views: bool
         """
         self.cb = f
+        self.cb_views = views
+
+    def route(self, topic_filter, handler):
+        """
+        Registers a handler for received messages whose topic matches a filter.
+
+        Messages are matched on their raw topic bytes. Every matching handler is called, and messages
+        that match no filter go to the callback set by set_callback. Subscribing is still up to the caller.
+
+        :param topic_filter: Topic filter, may contain '+' and '#' wildcards. Takes the form "path/+/topic"
+        :type topic_filter: str
+        :param handler: callable(topic, msg, retained, duplicate)
+        :return: None
+        """
+        if self._router is None:
+            self._router = Router()
+        self._router.add(topic_filter, handler)
 
     def set_callback_status(self, f):
         """
@@ -212,9 +959,411 @@ class MQTTClient:
             status = 1 - successfully delivered
             status = 2 - Unknown PID. It is also possible that the PID is outdated,
                          i.e. it came out of the message timeout.
+            status = 3 - Rejected by the server (MQTT 5 PUBACK with a Reason Code of 0x80 or above)
         """
         self.cbstat = f
 
+    def set_retransmit(self, max_inflight=8, slot_size=128, max_retries=3):
+        """
+        Keeps unacknowledged QoS 1 PUBLISH packets and sends them again with the DUP flag set when their
+        message_timeout expires or the client reconnects. status 0 is only reported to the callback set by
+        set_callback_status once max_retries retransmissions went unacknowledged.
+
+        Packets are kept in a slab of max_inflight slots allocated once. A packet larger than slot_size is not
+        kept, and is only reported on timeout as before, but it still counts against max_inflight.
+        publish() and publish_stream() raise MQTTException(6) with qos=1 when max_inflight messages await PUBACK.
+        With MQTT 5 such packets never use topic aliases, which don't survive a reconnect.
+        Retransmissions are counted in stats (retransmits).
+
+        :param max_inflight: Maximum number of QoS 1 messages awaiting PUBACK
+        :type max_inflight: int
+        :param slot_size: Largest packet kept for retransmission, in bytes
+        :type slot_size: int
+        :param max_retries: Retransmissions after a timeout before giving up. Resending on reconnect doesn't count.
+        :type max_retries: int
+        """
+        assert not self._inflight
+        self._slab = bytearray(max_inflight * slot_size)
+        self._slab_mv = memoryview(self._slab)
+        self._slot_size = slot_size
+        self._slot_len = [0] * max_inflight  # 0 - the packet did not fit in its slot
+        self._slot_tries = [0] * max_inflight
+        self._slot_seq = [0] * max_inflight  # Send order, kept on reconnect
+        self._seq = 0
+        self._free_slots = list(range(max_inflight))
+        self.max_retries = max_retries
+        self.stats.setdefault('retransmits', 0)
+
+    def _keep(self, pid, head=None, payload=b""):
+        """
+        Private class method. Takes a slot for a QoS 1 PUBLISH and copies the packet into it if it fits.
+
+        :param pid: Packet identifier
+        :type pid: int
+        :param head: Fixed and variable header of the packet. None - the packet is not kept.
+        :param payload: Payload of the packet
+        """
+        self._free_slot(pid)
+        slot = self._free_slots.pop()
+        self._inflight[pid] = slot
+        self._slot_seq[slot] = self._seq
+        self._seq += 1
+        self._slot_tries[slot] = 0
+        self._slot_len[slot] = 0
+        if head is None:
+            return
+        n = len(head) + len(payload)
+        if n <= self._slot_size:
+            o = slot * self._slot_size
+            self._slab[o:o + len(head)] = head
+            self._slab[o + len(head):o + n] = payload
+            self._slab[o] |= 0x08  # DUP, the copy is only ever sent again
+            self._slot_len[slot] = n
+
+    def _free_slot(self, pid):
+        slot = self._inflight.pop(pid, None)
+        if slot is not None:
+            self._free_slots.append(slot)
+
+    def _resend(self, pid):
+        """
+        Private class method. Sends a kept QoS 1 PUBLISH again and restarts its timeout.
+
+        :param pid: Packet identifier
+        :type pid: int
+        """
+        slot = self._inflight[pid]
+        n = self._slot_len[slot]
+        o = slot * self._slot_size
+        buf, i = self._begin(n)
+        buf[i:i + n] = self._slab_mv[o:o + n]
+        self._commit(buf, i + n)
+        self.stats['retransmits'] += 1
+        self._await_ack(pid)
+
+    def _resend_inflight(self):
+        """
+        Private class method. Sends every kept QoS 1 PUBLISH again after a reconnect, in their original order.
+        """
+        for pid, slot in sorted(self._inflight.items(), key=lambda e: self._slot_seq[e[1]]):
+            if self._slot_len[slot]:
+                self._resend(pid)
+            else:
+                self._free_slot(pid)
+                self.rcv_pids.pop(pid, None)
+                self.pids.free(pid)
+                self.cbstat(pid, 0)
+
+    def set_callback_stream(self, f, threshold=1024):
+        """
+        Set the callback for received messages too large to be delivered whole.
+
+        A PUBLISH whose Remaining Length exceeds the threshold is not assembled in memory: its payload is
+        passed to this callback in pieces, straight from the receive buffer, as it arrives. Such messages
+        bypass route(), set_callback() and decompression. A QoS 1 message is acknowledged after its last piece.
+
+        :param f: callable(topic, chunk, offset, total), where topic is bytes and chunk is a memoryview into
+                  the receive buffer, only valid during the call. offset is the position of chunk in the payload
+                  and total the payload size. None - turns streaming off.
+        :param threshold: Size in bytes above which messages are streamed.
+        :type threshold: int
+        """
+        self.cb_stream = f
+        self.stream_threshold = threshold
+
+    def set_compression(self, threshold=128, marker=b"\0z", suffix=None):
+        """
+        Enables deflate (zlib format) compression of large payloads.
+
+        Published payloads of at least threshold bytes are sent as marker followed by the compressed data,
+        unless that is not smaller than the original. Received payloads that start with marker are
+        decompressed before they reach the callback. Both ends must use the same marker.
+        On MicroPython, compression needs the deflate module (v1.21 or later).
+
+        The bytes before and after compression and the time spent are added to stats
+        (z_in, z_out, z_us and unz_us), so the bytes saved can be weighed against CPU time.
+
+        :param threshold: Minimum payload size in bytes to try compression. None disables compression.
+        :type threshold: int
+        :param marker: Prefix identifying compressed payloads. The default can't start a text or JSON payload.
+        :type marker: bytes
+        :param suffix: If set, only topics ending with this suffix are compressed and decompressed.
+        :type suffix: bytes
+        :return: None
+        """
+        self.z_threshold = threshold
+        self.z_marker = marker
+        self.z_suffix = _bytes(suffix)
+        for k in ('z_in', 'z_out', 'z_us', 'unz_us'):
+            self.stats.setdefault(k, 0)
+
+    def set_publish_cache(self, max_age=None, max_payload=64):
+        """
+        Skips publishes identical to the last message sent to the same topic.
+
+        A publish is identical when both payload and retain flag match. The cache is emptied on every connect,
+        so the first publish after a reconnect always goes out. Hits and misses are counted in stats
+        (cache_hits, cache_misses), see cache_hit_ratio().
+
+        :param max_age: Seconds after which an identical message is sent again anyway. None - never.
+        :type max_age: int
+        :param max_payload: Payloads longer than this are not cached and always sent.
+        :type max_payload: int
+        :return: None
+        """
+        self._lv = {}
+        self.lv_max_age = max_age
+        self.lv_max_payload = max_payload
+        self.stats.setdefault('cache_hits', 0)
+        self.stats.setdefault('cache_misses', 0)
+
+    def set_coalesce(self, topic_filters):
+        """
+        Delivers only the last of the messages received on the same topic in one pass of check_msg() or process().
+
+        Messages on topics matching one of the filters are held, replacing any earlier message held for the
+        same topic, and delivered once the pass has processed everything received so far. QoS 1 messages are
+        still acknowledged when received. Messages folded away are counted in stats (coalesced).
+
+        Only use it for topics whose messages replace each other, such as ON/OFF commands or set points.
+        Relative commands such as TOGGLE must not be coalesced, since two of them would count as one.
+
+        :param topic_filters: Topic filters, may contain '+' and '#' wildcards. None - turns coalescing off.
+        :type topic_filters: list
+        :return: None
+        """
+        self._coalesce = None
+        if topic_filters:
+            self._coalesce = Router()
+            for f in topic_filters:
+                self._coalesce.add(f, True)
+        self.stats.setdefault('coalesced', 0)
+
+    def set_offline_buffer(self, slots=16, slot_size=96, latest_only=None, rate=5):
+        """
+        Keeps messages published while disconnected and sends them in order once connected again.
+
+        Messages are kept in a ring of fixed-size slots allocated once, so memory use doesn't grow however long
+        the outage lasts. While the ring isn't empty, new messages are queued behind the older ones. A retained
+        message, or one on a topic matching latest_only, replaces the message queued for the same topic.
+        When the ring is full, the oldest message is dropped. check_msg(), process() and wait() send queued
+        messages, at most rate per second. A publish whose write fails, with OSError or MQTTException, is queued too
+        and the socket closed before the error is raised, so the application only has to reconnect.
+        Counted in stats: offline_queued, offline_replaced and offline_dropped (ring full or message too large).
+
+        :param slots: Number of messages kept
+        :type slots: int
+        :param slot_size: Largest message kept, topic and payload plus 3 bytes
+        :type slot_size: int
+        :param latest_only: Topic filters, may contain '+' and '#' wildcards, of not retained messages
+                            of which only the latest is kept.
+        :type latest_only: list
+        :param rate: Messages sent per second once connected
+        :type rate: int
+        :return: None
+        """
+        self._ob = bytearray(slots * slot_size)
+        self._ob_mv = memoryview(self._ob)
+        self._ob_size = slot_size
+        self._ob_len = [0] * slots  # Bytes used by each slot
+        self._ob_head = 0
+        self._ob_count = 0  # Slots in use from _ob_head on, including replaced ones
+        self._ob_live = 0
+        self._ob_latest = None
+        if latest_only:
+            self._ob_latest = Router()
+            for f in latest_only:
+                self._ob_latest.add(f, True)
+        self.ob_rate = rate
+        self._ob_tokens = rate * 1000
+        self._ob_last = ticks_ms()
+        for k in ('offline_queued', 'offline_replaced', 'offline_dropped'):
+            self.stats.setdefault(k, 0)
+
+    def offline_pending(self):
+        """
+        :return: Number of messages waiting in the offline buffer.
+        :rtype: int
+        """
+        return self._ob_live if self._ob is not None else 0
+
+    def _queue(self, topic, msg, retain=False, qos=0):
+        """
+        Private class method. Appends a message to the offline buffer.
+
+        Slot layout: flags (1 = in use, 2 = retain, 4 = qos 1), topic length (2 bytes), topic, payload.
+        """
+        topic = _bytes(topic)
+        if isinstance(topic, Topic):
+            topic = topic.name
+        msg = _bytes(msg)
+        size = self._ob_size
+        n = 3 + len(topic) + len(msg)
+        if n > size:
+            self.stats['offline_dropped'] += 1
+            return
+        slots = len(self._ob_len)
+        if retain or (self._ob_latest and self._ob_latest.match(topic, [])):
+            for k in range(self._ob_count):
+                o = (self._ob_head + k) % slots * size
+                if self._ob[o] and view_eq(self._ob_mv[o + 3:o + 3 + (self._ob[o + 1] << 8 | self._ob[o + 2])], topic):
+                    self._ob[o] = 0
+                    self._ob_live -= 1
+                    self.stats['offline_replaced'] += 1
+                    break
+        if self._ob_count == slots:
+            self._ob_compact()
+        if self._ob_count == slots:
+            self._ob_pop()
+            self.stats['offline_dropped'] += 1
+        s = (self._ob_head + self._ob_count) % slots
+        o = s * size
+        self._ob[o] = 1 | bool(retain) << 1 | bool(qos) << 2
+        self._ob[o + 1] = len(topic) >> 8
+        self._ob[o + 2] = len(topic) & 0xFF
+        self._ob[o + 3:o + 3 + len(topic)] = topic
+        self._ob[o + 3 + len(topic):o + n] = msg
+        self._ob_len[s] = n
+        self._ob_count += 1
+        self._ob_live += 1
+        self.stats['offline_queued'] += 1
+
+    def _ob_pop(self):
+        o = self._ob_head * self._ob_size
+        if self._ob[o]:
+            self._ob_live -= 1
+        self._ob[o] = 0
+        self._ob_head = (self._ob_head + 1) % len(self._ob_len)
+        self._ob_count -= 1
+
+    def _ob_compact(self):
+        """
+        Private class method. Moves the queued messages over the slots of replaced ones, keeping their order.
+        """
+        slots = len(self._ob_len)
+        size = self._ob_size
+        w = 0
+        for k in range(self._ob_count):
+            s = (self._ob_head + k) % slots
+            o = s * size
+            if not self._ob[o]:
+                continue
+            if w != k:
+                d = (self._ob_head + w) % slots
+                n = self._ob_len[s]
+                self._ob[d * size:d * size + n] = self._ob_mv[o:o + n]
+                self._ob_len[d] = n
+                self._ob[o] = 0
+            w += 1
+        self._ob_count = w
+
+    def _drain(self):
+        """
+        Private class method. Sends the messages of the offline buffer allowed by its rate, oldest first.
+        """
+        now = ticks_ms()
+        elapsed = ticks_diff(now, self._ob_last)
+        self._ob_last = now
+        if elapsed > 0:
+            self._ob_tokens = min(self._ob_tokens + elapsed * self.ob_rate, self.ob_rate * 1000)
+        size = self._ob_size
+        while self._ob_count and self._ob_tokens >= 1000:
+            o = self._ob_head * size
+            f = self._ob[o]
+            if f:
+                tl = self._ob[o + 1] << 8 | self._ob[o + 2]
+                # Removed only once sent, so a failed send is tried again after reconnecting
+                try:
+                    self._publish(bytes(self._ob_mv[o + 3:o + 3 + tl]),
+                                  self._ob_mv[o + 3 + tl:o + self._ob_len[self._ob_head]], f >> 1 & 1, f >> 2 & 1,
+                                  False)
+                except (OSError, MQTTException):
+                    if self._pub_kept:
+                        self._ob_pop()  # Sent again from the retransmit slab instead
+                    raise
+                self._ob_tokens -= 1000
+            self._ob_pop()
+
+    def set_dup_filter(self, size=64):
+        """
+        Drops QoS 1 messages redelivered by the server because their PUBACK was lost, so that a command
+        such as TOGGLE isn't executed twice. They are still acknowledged, and counted in stats (dup_dropped).
+
+        The pid of each received QoS 1 message is kept in slot pid % size of a table, and a message with the DUP
+        flag is dropped when its slot holds its pid.
+
+        :param size: Number of slots, a power of two. None - turns the filter off.
+        :type size: int
+        :return: None
+        """
+        assert size is None or not size & (size - 1)
+        self._rx_pids = [0] * size if size else None
+        self.stats.setdefault('dup_dropped', 0)
+
+    def _seen(self, pid, dup):
+        """
+        Private class method. Records the pid of a received QoS 1 message.
+
+        :return: True if the message is a redelivery of the last one received with this pid.
+        :rtype: bool
+        """
+        t = self._rx_pids
+        k = pid & (len(t) - 1)
+        if dup and t[k] == pid:
+            self.stats['dup_dropped'] += 1
+            return True
+        t[k] = pid
+        return False
+
+    def cache_hit_ratio(self):
+        """
+        :return: Fraction of publishes skipped by the last-value cache.
+        :rtype: float
+        """
+        n = self.stats.get('cache_hits', 0) + self.stats.get('cache_misses', 0)
+        return self.stats['cache_hits'] / n if n else 0.0
+
+    def _z_topic(self, topic):
+        if self.z_suffix is None:
+            return True
+        if isinstance(topic, Topic):
+            topic = topic.name
+        n = len(self.z_suffix)
+        return len(topic) >= n and view_eq(topic[len(topic) - n:], self.z_suffix)
+
+    def _compress(self, msg):
+        """
+        Private class method.
+
+        :param msg: Payload
+        :type msg: bytes
+        :return: Compressed payload with its marker, or msg if compression does not make it smaller.
+        :rtype: bytes
+        """
+        t = ticks_us()
+        z = _deflate(msg)
+        self.stats['z_us'] += ticks_diff(ticks_us(), t)
+        self.stats['z_in'] += len(msg)
+        if len(self.z_marker) + len(z) >= len(msg):
+            self.stats['z_out'] += len(msg)
+            return msg
+        self.stats['z_out'] += len(self.z_marker) + len(z)
+        return self.z_marker + z
+
+    def _decompress(self, msg):
+        """
+        Private class method.
+
+        :param msg: Received payload starting with the marker
+        :type msg: memoryview
+        :return: Decompressed payload
+        :rtype: bytes
+        """
+        t = ticks_us()
+        msg = _inflate(bytes(msg[len(self.z_marker):]))
+        self.stats['unz_us'] += ticks_diff(ticks_us(), t)
+        return msg
+
     def set_last_will(self, topic, msg, retain=False, qos=0):
         """
         Sets the last will and testament of the client. This is used to perform an action by the broker
@@ -281,7 +1430,7 @@ class MQTTClient:
         # 3,4 - protocol name length len('MQTT')
         # 5-8 = 'MQTT'
         # PROTOCOL LEVEL (3.1.2.2 Protocol Level)
-        # 9 - mqtt version 0x04
+        # 9 - mqtt version 0x04 (0x05 for MQTT 5)
         # CONNECT FLAGS
         # 10 - connection flags
         #  X... .... = User Name Flag
@@ -293,53 +1442,153 @@ class MQTTClient:
         #  .... ...0 = (Reserved) It must be 0!
         # KEEP ALIVE
         # 11,12 - keepalive
+        # MQTT 5 only: properties (Session Expiry Interval if session_expiry is set) and, with a will,
+        # will properties length
         # 13,14 - client ID length
         # 15-15+len(client_id) - byte(client_id)
-        premsg = bytearray(b"\x10\0\0\0\0\0")
-        msg = bytearray(b"\0\x04MQTT\x04\0\0\0")
-
-        sz = 10 + 2 + len(self.client_id)
+        client_id = _bytes(self.client_id)
+        user = _bytes(self.user)
+        pswd = _bytes(self.pswd)
+        lw_topic = _bytes(self.lw_topic)
+        lw_msg = _bytes(self.lw_msg)
 
-        msg[7] = bool(clean_session) << 1
+        v5 = self.protocol == 5
+        props = 5 if v5 and self.session_expiry else 0
+        sz = 10 + 2 + len(client_id) + v5 + props
+        flags = bool(clean_session) << 1
         # Clean session = True, remove current session
         if bool(clean_session):
             self.rcv_pids.clear()
-        if self.user is not None:
-            sz += 2 + len(self.user)
-            msg[7] |= 1 << 7  # User Name Flag
-            if self.pswd is not None:
-                sz += 2 + len(self.pswd)
-                msg[7] |= 1 << 6  # # Password Flag
-        if self.keepalive:
-            assert self.keepalive < 65536
-            msg[8] |= self.keepalive >> 8
-            msg[9] |= self.keepalive & 0x00FF
-        if self.lw_topic:
-            sz += 2 + len(self.lw_topic) + 2 + len(self.lw_msg)
-            msg[7] |= 0x4 | (self.lw_qos & 0x1) << 3 | (self.lw_qos & 0x2) << 3
-            msg[7] |= self.lw_retain << 5
-
-        plen = self._varlen_encode(sz, premsg, 1)
-        self._write(premsg, plen)
-        self._write(msg)
-        self._send_str(self.client_id)
-        if self.lw_topic:
-            self._send_str(self.lw_topic)
-            self._send_str(self.lw_msg)
-        if self.user is not None:
-            self._send_str(self.user)
-            if self.pswd is not None:
-                self._send_str(self.pswd)
-        resp = self._read(4)
-        if not (resp[0] == 0x20 and resp[1] == 0x02):  # control packet type, Remaining Length == 2
+            self.pids.reset(self._inflight)  # Messages kept for retransmission keep their pids
+            self._deadlines.clear()
+        else:
+            # Only ids still awaiting an ACK stay taken, any lost track of by a failed send are freed
+            self.pids.reset(tuple(self.rcv_pids) + tuple(self._inflight))
+        if user is not None:
+            sz += 2 + len(user)
+            flags |= 1 << 7  # User Name Flag
+            if pswd is not None:
+                sz += 2 + len(pswd)
+                flags |= 1 << 6  # # Password Flag
+        if lw_topic:
+            sz += 2 + len(lw_topic) + 2 + len(lw_msg) + v5
+            flags |= 0x4 | (self.lw_qos & 0x1) << 3 | (self.lw_qos & 0x2) << 3
+            flags |= self.lw_retain << 5
+        assert self.keepalive < 65536
+
+        self._wlen = 0
+        self._corked = False
+        self._rhead = self._rtail = 0
+        self._big = None
+        self._stream = None
+        buf, i = self._begin(5 + sz)
+        buf[i] = 0x10
+        i = self._varlen_encode(sz, buf, i + 1)
+        buf[i:i + 7] = b"\0\x04MQTT\x04"
+        buf[i + 6] = self.protocol
+        buf[i + 7] = flags
+        buf[i + 8] = self.keepalive >> 8
+        buf[i + 9] = self.keepalive & 0x00FF
+        i += 10
+        if v5:
+            buf[i] = props  # Properties length
+            if props:
+                buf[i + 1] = 0x11  # Session Expiry Interval
+                buf[i + 2:i + 6] = self.session_expiry.to_bytes(4, 'big')
+            i += 1 + props
+        i = self._put_str(buf, i, client_id)
+        if lw_topic:
+            if v5:
+                buf[i] = 0  # Will properties length
+                i += 1
+            i = self._put_str(buf, i, lw_topic)
+            i = self._put_str(buf, i, lw_msg)
+        if user is not None:
+            i = self._put_str(buf, i, user)
+            if pswd is not None:
+                i = self._put_str(buf, i, pswd)
+        self._commit(buf, i)
+        self._ping_sent = None
+        self._aliases = {}
+        if self._lv:
+            self._lv.clear()
+        if v5:
+            present = self._connack5()
+        else:
+            resp = self._read(4)
+            if not (resp[0] == 0x20 and resp[1] == 0x02):  # control packet type, Remaining Length == 2
+                raise MQTTException(29)
+            if resp[3] != 0:
+                if 1 <= resp[3] <= 5:
+                    raise MQTTException(20 + resp[3])
+                else:
+                    raise MQTTException(20, resp[3])
+            self.last_cpacket = ticks_ms()
+            present = resp[2] & 1  # Is existing persistent session of the client from previous interactions.
+        if self._inflight:
+            self._resend_inflight()
+        return present
+
+    def _connack5(self):
+        """
+        Private class method. Reads an MQTT 5 CONNACK and applies its properties.
+
+        :return: Existing persistent session of the client from previous interactions.
+        :rtype: bool
+        """
+        if self._read(1)[0] != 0x20:
             raise MQTTException(29)
-        if resp[3] != 0:
-            if 1 <= resp[3] <= 5:
-                raise MQTTException(20 + resp[3])
-            else:
-                raise MQTTException(20, resp[3])
+        resp = self._read(self._recv_len())
+        # Byte - desc
+        # 1 - Connect Acknowledge Flags
+        # 2 - Connect Reason Code
+        # 3... - Properties
+        if resp[1] != 0:
+            raise MQTTException(20, resp[1])
+        self.connack_props, _ = _parse_props(resp, 2)
+        self.topic_alias_max = self.connack_props.get(0x22, 0)  # Topic Alias Maximum
+        if 0x13 in self.connack_props:  # Server Keep Alive
+            self.keepalive = self.connack_props[0x13]
+        if 0x12 in self.connack_props:  # Assigned Client Identifier
+            self.client_id = self.connack_props[0x12]
         self.last_cpacket = ticks_ms()
-        return resp[2] & 1  # Is existing persistent session of the client from previous interactions.
+        return resp[0] & 1
+
+    def _topic_alias(self, topic):
+        """
+        Private class method. Looks up or assigns the MQTT 5 alias of an outbound topic.
+
+        :param topic: Topic
+        :type topic: bytes or Topic
+        :return: Alias (0 if none) and the topic to send, which is empty once the server knows the alias.
+        :rtype: tuple
+        """
+        if not self.topic_alias_max:
+            return 0, topic
+        key = topic.name if isinstance(topic, Topic) else topic
+        alias = self._aliases.get(key)
+        if alias:
+            return alias, b""
+        if len(self._aliases) < self.topic_alias_max:
+            alias = self._aliases[key] = len(self._aliases) + 1
+            return alias, topic
+        return 0, topic
+
+    def _put_pub_props(self, buf, i, alias):
+        """
+        Private class method. Writes the properties of an MQTT 5 PUBLISH.
+
+        :return: Position in buf after the properties
+        :rtype: int
+        """
+        if alias:
+            buf[i] = 3  # Properties length
+            buf[i + 1] = 0x23  # Topic Alias
+            buf[i + 2] = alias >> 8
+            buf[i + 3] = alias & 0xFF
+            return i + 4
+        buf[i] = 0
+        return i + 1
 
     def disconnect(self):
         """
@@ -348,10 +1597,22 @@ class MQTTClient:
         """
         if not self.sock:
             return
+        # Uncorked, so that held back packets are written together with DISCONNECT instead of being discarded
+        self._corked = False
         try:
-            self._write(b"\xe0\0")
+            self._send_const(b"\xe0\0")
         except (OSError, MQTTException):
             pass
+        self._close()
+
+    def _close(self):
+        """
+        Private class method. Closes the socket without sending DISCONNECT, so the server publishes the last will.
+
+        :return: None
+        """
+        if not self.sock:
+            return
         if self.poller_r:
             self.poller_r.unregister(self.sock)
         if self.poller_w:
@@ -363,21 +1624,78 @@ class MQTTClient:
         self.poller_r = None
         self.poller_w = None
         self.sock = None
+        self._wlen = 0
+        self._ping_sent = None
 
     def ping(self):
         """
         Pings the MQTT server.
+
+        The time until the PINGRESP is stored in ping_rtt. While keepalive is set, check_msg(), process()
+        and wait() also ping on their own, see set_auto_ping().
+
         :return: None
         """
-        self._write(b"\xc0\0")
+        self._send_const(b"\xc0\0")
         self.last_ping = ticks_ms()
+        if self._ping_sent is None:
+            self._ping_sent = self.last_ping
+
+    def set_auto_ping(self, fraction=0.5, timeout=None):
+        """
+        Sets when check_msg(), process() and wait() ping the server. They do it only while keepalive is not 0.
+
+        A PINGREQ is sent once nothing was written to the socket for a fraction of keepalive, so the server
+        never drops an idle client. If its PINGRESP does not arrive within timeout, the socket is closed
+        and MQTTException 31 is raised, instead of waiting for the next publish to fail.
+
+        :param fraction: Part of keepalive the client may stay silent. 0 - no automatic PINGREQ.
+        :type fraction: float
+        :param timeout: Seconds to wait for the PINGRESP. None - the same time as the silence before the PINGREQ.
+        :type timeout: float
+        :return: None
+        """
+        self.ping_fraction = fraction
+        self.ping_timeout = timeout
+
+    def _ping_deadline(self):
+        """
+        Private class method.
+
+        :return: Ticks at which _keepalive() has to send a PINGREQ or give up waiting for the PINGRESP,
+                 None if there is nothing to wait for.
+        :rtype: int
+        """
+        if not self.keepalive or not self.ping_fraction or not self.sock:
+            return None
+        every = int(self.keepalive * 1000 * self.ping_fraction)
+        if self._ping_sent is None:
+            return ticks_add(self._last_tx, every)
+        return ticks_add(self._ping_sent, every if self.ping_timeout is None else int(self.ping_timeout * 1000))
+
+    def _keepalive(self):
+        """
+        Private class method. Sends the PINGREQ or declares the link dead once _ping_deadline() is reached.
+
+        :return: None
+        """
+        due = self._ping_deadline()
+        if due is None or ticks_diff(due, ticks_ms()) > 0:
+            return
+        if self._ping_sent is None:
+            self.stats['pings'] += 1
+            self.ping()
+        else:
+            self.stats['dead_links'] += 1
+            self._close()
+            raise MQTTException(31)
 
     def publish(self, topic, msg, retain=False, qos=0, dup=False):
         """
         Publishes a message to a specified topic.
 
         :param topic: Topic you wish to publish to. Takes the form "path/to/topic"
-        :type topic: byte
+        :type topic: byte or Topic
         :param msg: Message to publish to topic.
         :type msg: byte
         :param retain: Have the MQTT broker retain the message.
@@ -386,54 +1704,332 @@ class MQTTClient:
         :type qos: int
         :param dup: Duplicate delivery of a PUBLISH Control Packet
         :type dup: bool
-        :return: None
+        :return: Packet id if qos=1 and the message was sent, else None
         """
         assert qos in (0, 1)
-        pkt = bytearray(b"\x30\0\0\0\0")
-        pkt[0] |= qos << 1 | retain | int(dup) << 3
+        if self._ob is not None:
+            if not self.sock or self._ob_count:
+                self._pub_kept = False
+                self._queue(topic, msg, retain, qos)
+                return None
+            try:
+                return self._publish(topic, msg, retain, qos, dup)
+            except (OSError, MQTTException) as e:
+                # Packets held back with it are lost too when corked, publish_many() queues them all
+                if self._corked or not _write_failed(e):
+                    raise
+                if not self._pub_kept:  # A copy in the retransmit slab is sent again after reconnecting
+                    self._queue(topic, msg, retain, qos)
+                self._close()  # No DISCONNECT, so the server still publishes the last will
+                raise
+        return self._publish(topic, msg, retain, qos, dup)
+
+    def _publish(self, topic, msg, retain, qos, dup):
+        """
+        Private class method. Publishes a message, see publish().
+        """
+        self._pub_kept = False
+        topic = _bytes(topic)
+        msg = _bytes(msg)
+        if self._lv is not None:
+            key = topic.name if isinstance(topic, Topic) else topic
+            e = self._lv.get(key)
+            if e and e[1] == bool(retain) and e[0] == msg and (
+                    self.lv_max_age is None or ticks_diff(ticks_ms(), e[2]) < self.lv_max_age * 1000):
+                self.stats['cache_hits'] += 1
+                return None
+            self.stats['cache_misses'] += 1
+            if len(msg) <= self.lv_max_payload:
+                value = (bytes(msg), bool(retain))
+            else:
+                value = None
+                self._lv.pop(key, None)
+        keep = qos > 0 and self._slab is not None
+        if keep and not self._free_slots:
+            raise MQTTException(6)
+        if self.z_threshold is not None and len(msg) >= self.z_threshold and self._z_topic(topic):
+            msg = self._compress(msg)
+        if self.protocol == 5:
+            alias, topic = (0, topic) if keep else self._topic_alias(topic)
         sz = 2 + len(topic) + len(msg)
         if qos > 0:
             sz += 2
-        plen = self._varlen_encode(sz, pkt, 1)
-        self._write(pkt, plen)
-        self._send_str(topic)
+        if self.protocol == 5:
+            sz += 4 if alias else 1
+        # Reserve room for the payload too when the whole packet can fit in the write buffer.
+        buf, i = self._begin(5 + sz if 5 + sz <= len(self._wbuf) else 5 + sz - len(msg))
+        start = i
+        buf[i] = 0x30 | qos << 1 | retain | int(dup) << 3
+        i = self._varlen_encode(sz, buf, i + 1)
+        i = self._put_str(buf, i, topic)
+        if qos > 0:
+            pid = self.pids.alloc()
+            buf[i] = pid >> 8
+            buf[i + 1] = pid & 0xFF
+            i += 2
+        if self.protocol == 5:
+            i = self._put_pub_props(buf, i, alias)
+        if keep:
+            self._keep(pid, memoryview(buf)[start:i], msg)
+            self._pub_kept = bool(self._slot_len[self._inflight[pid]])
+        try:
+            if i + len(msg) <= len(buf):
+                buf[i:i + len(msg)] = msg
+                self._commit(buf, i + len(msg))
+            else:
+                # The payload does not fit in the buffer: send it straight from msg instead of copying it.
+                self._commit(buf, i)
+                self._flush()
+                self._write(msg)
+        except (OSError, MQTTException):
+            # The pid would never be acknowledged, unless the retransmit slab holds a copy to send after reconnecting
+            if qos > 0 and not self._pub_kept:
+                self._free_slot(pid)
+                self.pids.free(pid)
+            raise
+        if self._lv is not None and value:
+            self._lv[key] = (value[0], value[1], ticks_ms())
+        if qos > 0:
+            self._await_ack(pid)
+            return pid
+
+    def publish_stream(self, topic, reader, length, retain=False, qos=0):
+        """
+        Publishes a message whose payload is read piece by piece instead of being held in RAM.
+
+        The payload is sent in chunks of at most buffer_size bytes through the write buffer.
+        If the reader ends before length bytes or a write fails, the connection is closed, since the server
+        still waits for the rest of the packet, and the error is raised (MQTTException(3) for a short reader).
+
+        :param topic: Topic you wish to publish to. Takes the form "path/to/topic"
+        :type topic: byte or Topic
+        :param reader: Source of the payload: an object with readinto() or read() such as a file opened in
+                       binary mode, or an iterable (e.g. a generator) of byte chunks.
+        :param length: Exact length of the payload in bytes.
+        :type length: int
+        :param retain: Have the MQTT broker retain the message.
+        :type retain: bool
+        :param qos: Sets quality of service level. Accepts values 0 to 1.
+        :type qos: int
+        :return: Packet id if qos=1, else None
+        """
+        assert qos in (0, 1)
+        topic = _bytes(topic)
+        keep = qos > 0 and self._slab is not None
+        if keep and not self._free_slots:
+            raise MQTTException(6)
+        if self.protocol == 5:
+            alias, topic = (0, topic) if keep else self._topic_alias(topic)
+        sz = 2 + len(topic) + length
+        if qos > 0:
+            sz += 2
+        if self.protocol == 5:
+            sz += 4 if alias else 1
+        buf, i = self._begin(5 + 2 + len(topic) + 2 + 4)
+        buf[i] = 0x30 | qos << 1 | retain
+        i = self._varlen_encode(sz, buf, i + 1)
+        i = self._put_str(buf, i, topic)
         if qos > 0:
-            pid = next(self.newpid)
-            self._write(pid.to_bytes(2, 'big'))
-        self._write(msg)
+            pid = self.pids.alloc()
+            buf[i] = pid >> 8
+            buf[i + 1] = pid & 0xFF
+            i += 2
+        if self.protocol == 5:
+            i = self._put_pub_props(buf, i, alias)
+        if keep:
+            self._keep(pid)  # Only counted against the window, the payload is not held in RAM
+        try:
+            self._commit(buf, i)
+            self._flush()
+            # The write buffer is empty now, so it doubles as the chunk buffer.
+            left = length
+            if hasattr(reader, 'readinto'):
+                mv = self._wmv
+                while left:
+                    n = reader.readinto(mv[:min(left, len(mv))])
+                    if not n:
+                        break
+                    self._write(mv, n)
+                    left -= n
+            elif hasattr(reader, 'read'):
+                while left:
+                    chunk = _bytes(reader.read(min(left, len(self._wbuf))))
+                    if not chunk:
+                        break
+                    self._write(chunk)
+                    left -= len(chunk)
+            else:
+                for chunk in reader:
+                    chunk = _bytes(chunk)
+                    if len(chunk) > left:
+                        break
+                    self._write(chunk)
+                    left -= len(chunk)
+                    if not left:
+                        break
+            if left:
+                raise MQTTException(3)
+        except (OSError, MQTTException):
+            # The PUBLISH is cut short on the wire: drop the connection and release its pid
+            if qos > 0:
+                self._free_slot(pid)
+                self.pids.free(pid)
+            self._close()
+            raise
         if qos > 0:
-            self.rcv_pids[pid] = ticks_add(ticks_ms(), self.message_timeout * 1000)
+            self._await_ack(pid)
             return pid
 
+    def publish_many(self, messages):
+        """
+        Publishes several messages with as few socket writes as possible.
+
+        :param messages: Iterable of tuples with the arguments of publish(), i.e. (topic, msg),
+                         (topic, msg, retain) or (topic, msg, retain, qos).
+        :type messages: iterable
+        :return: Number of published messages.
+        :rtype: int
+        """
+        if self._ob is not None:
+            messages = list(messages)
+        corked = self._corked
+        self._corked = True
+        n = 0
+        kept = []  # Messages with a copy in the retransmit slab
+        try:
+            try:
+                for m in messages:
+                    self.publish(*m)
+                    kept.append(self._pub_kept)
+                    n += 1
+            finally:
+                self._corked = corked
+            if not corked:
+                self._flush()
+        except (OSError, MQTTException) as e:
+            if self._ob is None or corked or not _write_failed(e):
+                raise
+            # Messages already written may not have arrived either, those kept in the slab are sent again from it
+            kept.append(self._pub_kept)  # The message that failed
+            for k, m in enumerate(messages):
+                if k >= len(kept) or not kept[k]:  # The loop stopped before publishing it
+                    self._queue(*m)
+            self._close()
+            raise
+        return n
+
+    def cork(self):
+        """
+        Holds back outgoing packets so that the following ones are sent together by flush().
+
+        Packets are still sent automatically whenever the write buffer (see buffer_size) is full.
+        Write errors of held back packets are raised by the call that sends them.
+
+        :return: None
+        """
+        self._corked = True
+
+    def flush(self):
+        """
+        Sends all packets held back since cork() with a single write and stops holding them back.
+
+        :return: None
+        """
+        self._corked = False
+        self._flush()
+
     def subscribe(self, topic, qos=0):
         """
         Subscribes to a given topic.
 
+        The subscription is remembered, so that resume() can send it again when the server lost the session.
+
         :param topic: Topic you wish to publish to. Takes the form "path/to/topic"
-        :type topic: byte
+        :type topic: byte or Topic
         :param qos: Sets quality of service level. Accepts values 0 to 1. This gives the maximum QoS level at which
                     the Server can send Application Messages to the Client.
         :type qos: int
         :return: None
         """
         assert qos in (0, 1)
-        assert self.cb is not None, "Subscribe callback is not set"
-        pkt = bytearray(b"\x82\0\0\0\0\0\0")
-        pid = next(self.newpid)
-        sz = 2 + 2 + len(topic) + 1
-        plen = self._varlen_encode(sz, pkt, 1)
-        pkt[plen:plen + 2] = pid.to_bytes(2, 'big')
-        self._write(pkt, plen + 2)
-        self._send_str(topic)
-        self._write(qos.to_bytes(1, "little"))  # maximum QOS value that can be given by the server to the client
-        self.rcv_pids[pid] = ticks_add(ticks_ms(), self.message_timeout * 1000)
+        assert self.cb is not None or self._router, "Subscribe callback is not set"
+        topic = _bytes(topic)
+        self._subs[topic.name if isinstance(topic, Topic) else topic] = qos
+        return self._subscribe(((topic, qos),))
+
+    def _subscribe(self, filters):
+        """
+        Private class method. Sends a single SUBSCRIBE for several topic filters.
+
+        :param filters: (topic, qos) pairs
+        :return: Packet id
+        :rtype: int
+        """
+        v5 = self.protocol == 5
+        sz = 2 + v5
+        for topic, qos in filters:
+            sz += 2 + len(topic) + 1
+        buf, i = self._begin(5 + sz)
+        pid = self.pids.alloc()
+        buf[i] = 0x82
+        i = self._varlen_encode(sz, buf, i + 1)
+        buf[i] = pid >> 8
+        buf[i + 1] = pid & 0xFF
+        i += 2
+        if v5:
+            buf[i] = 0  # Properties length
+            i += 1
+        for topic, qos in filters:
+            i = self._put_str(buf, i, topic)
+            buf[i] = qos  # maximum QOS value that can be given by the server to the client
+            i += 1
+        try:
+            self._commit(buf, i)
+        except (OSError, MQTTException):
+            self.pids.free(pid)
+            raise
+        self._await_ack(pid)
         return pid
 
+    def resume(self, session_expiry=3600):
+        """
+        Connects without starting a new session, so that subscriptions and QoS 1 messages sent to them
+        while the client was away are kept by the server. Only if the server no longer has the session,
+        every topic filter passed to subscribe() is subscribed to again, in a single SUBSCRIBE.
+
+        :param session_expiry: MQTT 5 only. Seconds the server keeps the session after the connection is lost.
+        :type session_expiry: int
+        :return: Existing persistent session of the client from previous interactions.
+        :rtype: bool
+        """
+        if self.protocol == 5:
+            self.session_expiry = session_expiry
+        present = self.connect(clean_session=False)
+        if not present and self._subs:
+            self._subscribe(list(self._subs.items()))
+        return present
+
+    def _await_ack(self, pid):
+        timeout = ticks_add(ticks_ms(), self.message_timeout * 1000)
+        self.rcv_pids[pid] = timeout
+        _heap_push(self._deadlines, (timeout, pid))
+
     def _message_timeout(self):
+        # Deadlines are kept in a heap ordered by expiry, so only the earliest one is looked at until it expires.
+        # Entries of pids acknowledged in the meantime are not removed, they are discarded when they reach the top.
+        heap = self._deadlines
         curr_tick = ticks_ms()
-        for pid, timeout in self.rcv_pids.items():
-            if ticks_diff(timeout, curr_tick) <= 0:
+        while heap and ticks_diff(heap[0][0], curr_tick) <= 0:
+            timeout, pid = _heap_pop(heap)
+            if self.rcv_pids.get(pid) == timeout:
+                slot = self._inflight.get(pid)
+                if slot is not None and self._slot_len[slot] and self._slot_tries[slot] < self.max_retries:
+                    self._slot_tries[slot] += 1
+                    self._resend(pid)
+                    continue
                 self.rcv_pids.pop(pid)
+                self._free_slot(pid)
+                self.pids.free(pid)
                 self.cbstat(pid, 0)
 
     def check_msg(self):
@@ -449,97 +2045,271 @@ class MQTTClient:
         - messages from subscribed topics that are processed by functions set by the set_callback method.
         - reply from the server that he received a QoS=1 message or subscribed to a topic
 
-        :return: None
+        While keepalive is set it also sends PINGREQ when the client was silent for too long, and raises
+        MQTTException 31 when the PINGRESP is late, see set_auto_ping().
+
+        Incoming data is read in bulk into the receive buffer and every complete packet in it is processed.
+        Unless socket_timeout=None, it never waits for the rest of a partially received packet: the part
+        already received is kept and parsing resumes on the next call.
+
+        :return: First byte of the last processed packet if it was not a PUBLISH or PINGRESP, else None
         """
-        if self.sock:
-            try:
-                res = self.sock.read(1)
-                if res is None:
-                    # wait forever if no timeout, else wait 1 msec
-                    if not self.poller_r.poll(-1 if self.socket_timeout is None else 1):
-                        self._message_timeout()
-                        return None
-                    res = self.sock.read(1)
-                    if res is None:
-                        self._message_timeout()
-                        return None
-            except OSError as e:
-                # 110: ETIMEDOUT 11: EAGAIN/EWOULDBLOCK
-                if e.args[0] == 110 or e.args[0] == 11:
-                    self._message_timeout()
-                    return None
-                else:
-                    raise e
+        if not self.sock:
+            raise MQTTException(28)
+        pkt = self._next_packet(False)
+        if pkt is None:
+            # wait forever if no timeout, else wait 1 msec
+            if self.poller_r.poll(-1 if self.socket_timeout is None else 1):
+                pkt = self._next_packet(self.socket_timeout is None)
+        res = None
+        while pkt is not None:
+            res = self._handle_packet(pkt[0], pkt[1])
+            pkt = self._next_packet(False)
+        self._release()
+        if self._ob is not None and self._ob_count:
+            self._drain()
+        self._message_timeout()
+        self._keepalive()
+        return res
+
+    def process(self, max_packets=None, max_ms=None):
+        """
+        Processes the packets received so far, PUBLISH as well as PUBACK, SUBACK and PINGRESP,
+        without waiting for more.
+
+        The socket is read until it has no more data or a budget is spent, so a backlog of commands
+        is cleared in one call instead of one per main loop iteration.
+
+        :param max_packets: Maximum number of packets to process. None - no limit.
+        :type max_packets: int
+        :param max_ms: Stop after the packet that exceeds this time budget in milliseconds. None - no limit.
+        :type max_ms: int
+        :return: Number of processed packets.
+        :rtype: int
+        """
+        if not self.sock:
+            raise MQTTException(28)
+        start = ticks_ms()
+        n = 0
+        while max_packets is None or n < max_packets:
+            pkt = self._next_packet(False)
+            if pkt is None:
+                break
+            self._handle_packet(pkt[0], pkt[1])
+            n += 1
+            if max_ms is not None and ticks_diff(ticks_ms(), start) >= max_ms:
+                break
+        self._release()
+        if self._ob is not None and self._ob_count:
+            self._drain()
+        self._message_timeout()
+        self._keepalive()
+        return n
+
+    def wait(self, timeout_ms=-1):
+        """
+        Sleeps until data arrives from the server or the timeout expires, then processes it as process() does.
+
+        Packets already received are processed without sleeping. The call may return 0 before the timeout,
+        e.g. when only part of a packet arrived, or to send the automatic PINGREQ on time.
+
+        :param timeout_ms: Maximum time to sleep in milliseconds. -1 - no limit.
+        :type timeout_ms: int
+        :return: Number of processed packets.
+        :rtype: int
+        """
+        n = self.process()
+        if n:
+            return n
+        due = self._ping_deadline()
+        if due is not None:
+            due = max(ticks_diff(due, ticks_ms()), 0)
+            if timeout_ms < 0 or due < timeout_ms:
+                timeout_ms = due
+        if self.poller_r.poll(timeout_ms):
+            n = self.process()
         else:
+            self._keepalive()
+        return n
+
+    def register(self, poller):
+        """
+        Registers the client socket in a caller-owned uselect.poll, so the main loop can sleep on it
+        together with UART or other streams. Call process() when is_sock() matches a returned object.
+
+        The socket changes on every connect(): unregister() the old one, and register again after. unregister()
+        still works once the connection is lost, since the registered socket is remembered.
+
+        :param poller: Poll object
+        :type poller: uselect.poll
+        :return: None
+        """
+        if not self.sock:
             raise MQTTException(28)
+        poller.register(self.sock, uselect.POLLIN)
+        self._registered = self.sock
+
+    def unregister(self, poller):
+        """
+        :param poller: Poll object the client socket was registered in with register()
+        :type poller: uselect.poll
+        :return: None
+        """
+        if self._registered is not None:
+            poller.unregister(self._registered)
+
+    def is_sock(self, obj):
+        """
+        :param obj: Object returned by uselect.poll.poll() or ipoll()
+        :return: True if obj is the client socket
+        :rtype: bool
+        """
+        return obj is self.sock
 
-        if res == b'':
-            raise MQTTException(1) # Connection closed by host
+    def _handle_packet(self, op, body):
+        """
+        Private class method. Processes one received packet.
+
+        :param op: First byte of the fixed header
+        :type op: int
+        :param body: Packet after the fixed header, None for a PUBLISH already delivered by streaming
+        :type body: memoryview
+        :return: op for packets other than PUBLISH and PINGRESP, else None
+        """
+        if body is None:
+            return
+        sz = len(body)
 
-        if res == b"\xd0":  # PINGRESP
-            if self._read(1)[0] != 0:
-                MQTTException(-1)
+        if op == 0xd0:  # PINGRESP
+            if sz != 0:
+                raise MQTTException(-1)
             self.last_cpacket = ticks_ms()
+            if self._ping_sent is not None:
+                self.ping_rtt = ticks_diff(self.last_cpacket, self._ping_sent)
+                self._ping_sent = None
             return
 
-        op = res[0]
+        if op == 0xe0:  # DISCONNECT, sent by MQTT 5 servers
+            raise MQTTException(1)
 
         if op == 0x40:  # PUBACK
-            sz = self._read(1)
-            if sz != b"\x02":
+            if sz < 2 or (sz != 2 and self.protocol == 4):
                 raise MQTTException(-1)
-            rcv_pid = int.from_bytes(self._read(2), 'big')
+            # MQTT 5 may add a Reason Code and properties after the PID
+            rcv_pid = body[0] << 8 | body[1]
             if rcv_pid in self.rcv_pids:
                 self.last_cpacket = ticks_ms()
                 self.rcv_pids.pop(rcv_pid)
-                self.cbstat(rcv_pid, 1)
+                self._free_slot(rcv_pid)
+                self.pids.free(rcv_pid)
+                self.cbstat(rcv_pid, 3 if sz > 2 and body[2] >= 0x80 else 1)
             else:
                 self.cbstat(rcv_pid, 2)
 
         if op == 0x90:  # SUBACK Packet fixed header
-            resp = self._read(4)
             # Byte - desc
-            # 1 - Remaining Length 2(varible header) + len(payload)=1
-            # 2,3 - PID
-            # 4 - Payload
-            if resp[0] != 0x03:
-                raise MQTTException(40, resp)
-            if resp[3] == 0x80:
-                raise MQTTException(44)
-            if resp[3] not in (0, 1, 2):
-                raise MQTTException(40, resp)
-            pid = resp[2] | (resp[1] << 8)
+            # 1,2 - PID
+            # MQTT 5 only: properties
+            # 3... - Payload, a Return Code per topic filter (resume() subscribes to several at once)
+            if self.protocol == 5:
+                _, i = _parse_props(body, 2)
+            elif sz < 0x03:
+                raise MQTTException(40, bytes(body))
+            else:
+                i = 2
+            for k in range(i, sz):
+                if body[k] >= 0x80:
+                    raise MQTTException(44)
+                if body[k] not in (0, 1, 2):
+                    raise MQTTException(40, bytes(body))
+            pid = body[1] | (body[0] << 8)
             if pid in self.rcv_pids:
                 self.last_cpacket = ticks_ms()
                 self.rcv_pids.pop(pid)
+                self.pids.free(pid)
                 self.cbstat(pid, 1)
             else:
                 raise MQTTException(5)
 
-        self._message_timeout()
-
         if op & 0xf0 != 0x30:  # 3.3 PUBLISH – Publish message
             return op
-        sz = self._recv_len()
-        topic_len = int.from_bytes(self._read(2), 'big')
-        topic = self._read(topic_len)
-        sz -= topic_len + 2
+        topic_len = body[0] << 8 | body[1]
+        i = 2 + topic_len
+        handlers = self._matched
+        if self._router:
+            handlers.clear()
+            self._router.match(body[2:i], handlers)
+        topic = body[2:i]
         if op & 6:  # QoS level > 0
-            pid = int.from_bytes(self._read(2), 'big')
-            sz -= 2
-        msg = self._read(sz) if sz else b''
+            pid = body[i] << 8 | body[i + 1]
+            i += 2
+            if op & 6 == 2 and self._rx_pids and self._seen(pid, op & 0x08):
+                self.last_cpacket = ticks_ms()
+                self._puback(pid)
+                return
+        if self.protocol == 5:  # Properties are skipped
+            n, i = _varlen_decode(body, i)
+            i += n
+        msg = body[i:]
         retained = op & 0x01
         dup = op & 0x08
-        self.cb(topic, msg, bool(retained), bool(dup))
+        m = self.z_marker
+        if m and len(msg) >= len(m) and view_eq(msg[:len(m)], m) and self._z_topic(topic):
+            msg = memoryview(self._decompress(msg))
+        held = None
+        if self._coalesce:
+            held = self._coalesce.match(topic, [])
+        if held:
+            self._hold(bytes(topic), bytes(msg), retained, dup)
+        else:
+            if not self.cb_views:
+                topic = bytes(topic)
+                msg = bytes(msg)
+            self._deliver(topic, msg, retained, dup)
         self.last_cpacket = ticks_ms()
         if op & 6 == 2:  # QoS==1
-            self._write(b"\x40\x02")  # Send PUBACK
-            self._write(pid.to_bytes(2, 'big'))
+            self._puback(pid)
         elif op & 6 == 4:  # QoS==2
             raise NotImplementedError()
         elif op & 6 == 6:  # 3.3.1.2 QoS - Reserved – must not be used
             raise MQTTException(-1)
 
+    def _deliver(self, topic, msg, retained, dup):
+        """
+        Private class method. Passes a message to the handlers in _matched, or to the callback if there are none.
+        """
+        handlers = self._matched
+        if self._router and handlers:
+            for h in handlers:
+                h(topic, msg, bool(retained), bool(dup))
+        elif self.cb:
+            self.cb(topic, msg, bool(retained), bool(dup))
+
+    def _hold(self, topic, msg, retained, dup):
+        """
+        Private class method. Keeps a coalesced message until _release(), replacing the one held for its topic.
+        """
+        for m in self._held:
+            if m[0] == topic:
+                m[1] = msg
+                m[2] = retained
+                m[3] = dup
+                self.stats['coalesced'] += 1
+                return
+        self._held.append([topic, msg, retained, dup])
+
+    def _release(self):
+        """
+        Private class method. Delivers the messages held by coalescing, in the order their topics were first received.
+        """
+        held = self._held
+        while held:
+            topic, msg, retained, dup = held.pop(0)
+            if self._router:
+                self._matched.clear()
+                self._router.match(topic, self._matched)
+            self._deliver(topic, msg, retained, dup)
+
     def wait_msg(self):
         """
         This method waits for a message from the server.